@@ -1,109 +1,78 @@
-import json
 import logging
 import time
-from contextlib import closing
-from datetime import datetime
-from typing import List, Optional, Dict
+from datetime import datetime, timedelta
+from typing import Optional
 
-from aviatracker.database import DB
+from aviatracker.database import DAY_PARTITIONED_TABLES, pooled_db
 from aviatracker.config import common_conf
-from aviatracker.database import FlightPath
+from aviatracker.metrics import Counter, Histogram
 
 
 logger = logging.getLogger()
 params = common_conf.db_params
 
+# active_flights is rebuilt from flight_paths when the paths worker updates the paths for the first time,
+# so the changes made while no worker was running are taken into account
+active_flights_rebuilt = False
 
-def update_flight_paths() -> None:
-    start = time.time()
-    with closing(DB(**params)) as db:
-        with db:
-            db.delete_outdated_paths()
-            db.update_paths_when_finished()
-        with db:
-            states: Optional[List[Dict]] = db.get_current_states()
-
-            if states is not None:
-                logger.info(f"received {len(states)} states for paths update")
-                for state in states:
-                    icao = state["icao24"]
-                    callsign = state["callsign"]
-                    update_time = state["request_time"]
+PATHS_UPDATE_SECONDS = Histogram("aviatracker_paths_update_seconds", "Duration of the updates of flight paths")
+PATHS_CHANGED = Counter("aviatracker_paths_changed_total", "Flight paths changed by the updates", ("change",))
 
-                    unfinished_path: Optional[Dict] = db.find_unfinished_path_for_aircraft(icao)
+# days a partition is kept for after its day is over, paths are started within a day before they are finished
+RETENTION_DAYS = {"flight_paths": 6, "flight_path_points": 6, "airport_stats": 31}
+PARTITIONS_AHEAD = 3
 
-                    current_location = {
-                        "longitude": state["longitude"],
-                        "latitude": state["latitude"],
-                    }
-                    path: str = json.dumps(current_location)
 
-                    if callsign is not None:
-                        airports = db.get_airports_for_callsign(callsign)
-                        if airports is not None:
-                            arrival_airport_icao, departure_airport_icao = airports
-                        else:
-                            arrival_airport_icao, departure_airport_icao = None, None  # type: ignore
-
-                    if unfinished_path:
-                        last_update = unfinished_path["last_update"]
-                        db.update_unfinished_path(
-                            icao, last_update, path, update_time, arrival_airport_icao, departure_airport_icao
-                        )
-                    else:
-                        flight_path = json.dumps([current_location])
-                        new_path = FlightPath(
-                            last_update=update_time,
-                            icao24=icao,
-                            callsign=callsign,
-                            departure_airport_icao=departure_airport_icao,
-                            arrival_airport_icao=arrival_airport_icao,
-                            path=flight_path,
-                            finished=False,
-                            finished_at=0,
-                        )
-
-                        db.insert_path(new_path)
+def update_flight_paths(now: Optional[int] = None) -> None:
+    global active_flights_rebuilt
+    start = time.time()
+    with pooled_db(params) as db:
+        if not active_flights_rebuilt:
+            with db:
+                active = db.rebuild_active_flights()
+            active_flights_rebuilt = True
+            logger.info(f"{active} active flights indexed")
+        with db:
+            db.update_paths_when_finished(now)
+        with db:
+            updated = db.append_current_states_to_paths()
+            inserted = db.insert_paths_for_new_aircraft()
+            logger.info(f"{updated} paths updated, {inserted} paths started")
     finish = time.time()
     delta = finish - start
+    PATHS_UPDATE_SECONDS.observe(delta)
+    PATHS_CHANGED.labels("updated").inc(updated)
+    PATHS_CHANGED.labels("started").inc(inserted)
     logger.info(f"{delta} sec to update paths")
 
 
-def update_airport_stats() -> None:
-    with closing(DB(**params)) as db:
+def update_airport_stats(now: Optional[int] = None) -> None:
+    """Adds the paths finished since the previous run to the stats of the days which are still kept.
+    now is the current time by default, replays pass the time of the replayed snapshot."""
+    today = datetime.utcfromtimestamp(time.time() if now is None else now).date()
+    with pooled_db(params) as db:
         with db:
-            db.delete_outdated_stats()
-
             last_update: int = db.get_stats_last_update()
+            first_day = today - timedelta(days=RETENTION_DAYS["airport_stats"])
+            max_update: int = db.add_finished_paths_to_stats(last_update, first_day)
 
-            not_considered_paths = db.get_not_considered_paths(last_update)
-            logger.debug(f"Quantity of not considered in stats calculation paths: {len(not_considered_paths)}")
-
-            max_update = 0
-
-            for path in not_considered_paths:
-                path = FlightPath(*path[1:])
-                update = path.last_update
-                update_day = datetime.utcfromtimestamp(update).strftime("%Y-%m-%d")
-
-                arrival_airport = path.arrival_airport_icao
-                if arrival_airport:
-                    arr_stats = db.get_stats_for_airport(arrival_airport, update_day)
-                    if arr_stats:
-                        db.update_stats_for_arrival_airport(arrival_airport, update_day)
-                    else:
-                        db.insert_arrival_airport_stats(arrival_airport, update_day)
-
-                departure_airport = path.departure_airport_icao
-                if departure_airport:
-                    dep_stats = db.get_stats_for_airport(departure_airport, update_day)
-                    if dep_stats:
-                        db.update_stats_for_departure_airport(departure_airport, update_day)
-                    else:
-                        db.insert_departure_airport_stats(departure_airport, update_day)
+            if max_update != last_update:
+                db.update_airport_stats_last_update(max_update)
 
-                if update > max_update:
-                    max_update = update
 
-            if max_update != 0:
-                db.update_airport_stats_last_update(max_update)
+def maintain_partitions() -> None:
+    """Creates the partitions for the next days and drops the outdated ones. The partition of yesterday is created
+    as well, as the stats of the paths finished after midnight are counted for the day of their last update.
+    The tables created before they were partitioned are cleaned up with DELETE instead."""
+    today = datetime.utcnow().date()
+    with pooled_db(params) as db:
+        for table in DAY_PARTITIONED_TABLES:
+            with db:
+                if db.is_partitioned(table):
+                    created = db.create_day_partitions(table, today - timedelta(days=1), PARTITIONS_AHEAD + 1)
+                    dropped = db.drop_day_partitions(table, today - timedelta(days=RETENTION_DAYS[table]))
+                    logger.info(f"{table}: partitions {created} created, {dropped} dropped")
+                elif table == "flight_paths":
+                    db.delete_outdated_paths()
+                elif table == "airport_stats":
+                    db.delete_outdated_stats()
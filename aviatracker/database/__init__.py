@@ -7,5 +7,14 @@ from aviatracker.database.entities import (
     StateVector,
     OpenskyFlight,
 )
-from aviatracker.database.utils import column_value_to_str
-from aviatracker.database.database import DB
+from aviatracker.database.utils import column_value_to_str, rows_to_copy_buffer
+from aviatracker.database.database import (
+    DB,
+    AIRPORTS_CHANNEL,
+    CALLSIGNS_CHANNEL,
+    DAY_PARTITIONED_TABLES,
+    STATES_CHANNEL,
+)
+from aviatracker.database.cache import CallsignCache, callsign_cache
+from aviatracker.database.pool import DBPool, PoolTimeout, get_pool, pooled_db
+from aviatracker.database.green import patch_psycopg, unpatch_psycopg
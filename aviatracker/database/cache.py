@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aviatracker.database.database import DB
+
+
+logger = logging.getLogger()
+
+
+class CallsignCache:
+    """Bounded LRU cache of callsign -> (arrival airport, departure airport) with a TTL for every entry.
+    Absent callsigns are cached as well, so that each of them costs at most one query per TTL.
+    If the whole callsign_memo fits into the cache after warm(), absent callsigns are not queried at all."""
+
+    def __init__(self, max_size: int = 100000, ttl: int = 600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._complete = False
+        self._warmed_at: Optional[float] = None
+        self._entries: "OrderedDict[str, Tuple[float, Optional[Tuple[str, str]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def warm(self, db: DB) -> None:
+        """Loads the whole callsign_memo with a single query"""
+        memo: Dict[str, Tuple[str, str]] = db.get_all_callsign_airports()
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries.clear()
+            for callsign, airports in memo.items():
+                self._put(callsign, airports, expires)
+            self._complete = len(memo) <= self.max_size
+            self._warmed_at = time.monotonic()
+        logger.info(f"Callsign cache has been warmed with {len(self._entries)} callsigns")
+
+    def refresh(self, db: DB) -> None:
+        """Warms the cache if it has been invalidated or its entries have expired"""
+        if self._warmed_at is None or time.monotonic() - self._warmed_at > self.ttl:
+            self.warm(db)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._complete = False
+            self._warmed_at = None
+            self.version += 1
+
+    def get_airports(self, db: DB, callsign: Optional[str]) -> Optional[Tuple[str, str]]:
+        if not callsign:
+            return None
+        callsign = callsign.strip().upper()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(callsign)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(callsign)
+                self.hits += 1
+                return entry[1]
+            if entry is None and self._complete:
+                self.hits += 1
+                return None
+            self.misses += 1
+            version = self.version
+
+        airports: Optional[Tuple[str, str]] = db.get_airports_for_callsign(callsign)
+
+        with self._lock:
+            if version == self.version:
+                self._put(callsign, airports, now + self.ttl)
+        return airports
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "version": self.version}
+
+    def reset_stats(self) -> None:
+        self.hits, self.misses = 0, 0
+
+    def _put(self, callsign: str, airports: Optional[Tuple[str, str]], expires: float) -> None:
+        self._entries[callsign] = (expires, airports)
+        self._entries.move_to_end(callsign)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._complete = False
+
+
+callsign_cache = CallsignCache()
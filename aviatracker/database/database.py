@@ -1,14 +1,20 @@
+import calendar
+import functools
 import logging
+import threading
 import time
-from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from psycopg2 import connect, extras
+from psycopg2 import Error, connect, extras
+from psycopg2.extensions import cursor
 
+from aviatracker.metrics import Counter, Histogram
 from aviatracker.database import (
     Airport,
-    AirportStats,
     CallsignMemo,
     column_value_to_str,
+    rows_to_copy_buffer,
     FlightAirportInfo,
     FlightPath,
     StateVector,
@@ -18,22 +24,89 @@ from aviatracker.database import (
 
 logger = logging.getLogger()
 
+CALLSIGNS_CHANNEL = "callsign_memo_changed"
+AIRPORTS_CHANNEL = "airports_changed"
+# the payload of a notification is the request_time of the snapshot of current states which has been committed
+STATES_CHANNEL = "current_states_published"
+
+# buffers of current_states, the latest complete snapshot is in the one current_states_pointer points to
+CURRENT_STATES_TABLES = ("current_states_a", "current_states_b")
+
+# tables partitioned by day in make_tables.yaml, the partition key of the others is a unix timestamp
+DAY_PARTITIONED_TABLES = ("flight_paths", "flight_path_points", "airport_stats")
+DATE_PARTITIONED_TABLES = ("airport_stats",)
+
+# columns of flight_paths in the order of FlightPath, the path is put together from the legacy JSONB column
+# which is kept for the paths written before flight_path_points and the points appended to the path since then
+FLIGHT_PATH_COLUMNS = (
+    "fp.last_update, fp.icao24, fp.callsign, fp.departure_airport_icao, fp.arrival_airport_icao, "
+    "COALESCE(fp.path, '[]'::jsonb) || COALESCE(("
+    "SELECT jsonb_agg(jsonb_build_object('longitude', p.longitude, 'latitude', p.latitude) ORDER BY p.point_id) "
+    "FROM flight_path_points AS p WHERE p.path_id = fp.path_id), '[]'::jsonb), "
+    "fp.finished, fp.finished_at"
+)
+
+
+DB_CALL_SECONDS = Histogram("aviatracker_db_call_seconds", "Duration of the calls of DB methods", ("method",))
+DB_QUERIES = Counter("aviatracker_db_queries_total", "Queries sent to Postgres by DB methods", ("method",))
+
+# the outermost @_timed DB method called by the thread, the queries of the methods it calls are counted for it
+_call = threading.local()
+
+
+class CountingCursor(cursor):
+    def execute(self, query: Any, vars: Any = None) -> Any:
+        DB_QUERIES.labels(getattr(_call, "method", None) or "other").inc()
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql: Any, file: Any, size: int = 8192) -> Any:
+        DB_QUERIES.labels(getattr(_call, "method", None) or "other").inc()
+        return super().copy_expert(sql, file, size)
+
+
+def _timed(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if getattr(_call, "method", None) is not None:
+            return method(*args, **kwargs)
+        _call.method = method.__name__
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            DB_CALL_SECONDS.labels(method.__name__).observe(time.perf_counter() - start)
+            _call.method = None
+
+    return wrapper
+
 
 class DB:
     def __init__(self, name: str, user: str, password: str, host: str, port: int) -> None:
         logger.info(f"Connecting to the PostgreSQL database - {user}@{host}:{port}/{name}")
-        self.conn = connect(dbname=name, user=user, password=password, host=host, port=port)
+        self.conn = connect(
+            dbname=name, user=user, password=password, host=host, port=port, cursor_factory=CountingCursor
+        )
 
         with self.conn:
             with self.conn.cursor() as curs:
                 curs.execute("SELECT 1;")
         logger.info(f"Connected to the Postgres database - {user}@{host}:{port}/{name}")
 
+    def is_alive(self) -> bool:
+        try:
+            with self.conn:
+                with self.conn.cursor() as curs:
+                    curs.execute("SELECT 1;")
+            return True
+        except Error:
+            return False
+
     def set_timezone(self) -> None:
         with self.conn.cursor() as curs:
             curs.execute("SET timezone = 0;")
 
     def insert_airports(self, airports: List[Dict]) -> None:
+        """Listeners of AIRPORTS_CHANNEL are notified when the airports are committed."""
         logger.info(f"airports: {airports[0]}")
         with self.conn:
             with self.conn.cursor() as curs:
@@ -48,32 +121,86 @@ class DB:
                 curs.execute("UPDATE airports SET name = REPLACE (name, '\"', '');")
                 curs.execute("UPDATE airports SET city = REPLACE (city, '\"', '');")
                 curs.execute("UPDATE airports SET country = REPLACE (country, '\"', '');")
+                self.notify(AIRPORTS_CHANNEL)
+
+    @_timed
+    def get_current_states_table(self) -> str:
+        """Returns the buffer of current states holding the latest complete snapshot."""
+        with self.conn.cursor() as curs:
+            curs.execute("SELECT active FROM current_states_pointer")
+            record = curs.fetchone()
+            if record is None or record[0] not in CURRENT_STATES_TABLES:
+                return CURRENT_STATES_TABLES[0]
+            return record[0]
 
+    @_timed
+    def get_current_states_request_time(self) -> int:
+        """Returns request_time of the latest complete snapshot, 0 if none has been published yet."""
+        with self.conn.cursor() as curs:
+            curs.execute("SELECT request_time FROM current_states_pointer")
+            record = curs.fetchone()
+            return (record[0] or 0) if record else 0
+
+    def _start_current_states_swap(self, curs: cursor) -> str:
+        """Locks the pointer row, so there is only one writer at a time, and empties the inactive buffer.
+        TRUNCATE leaves no dead rows behind, the readers are never blocked by it as they read the other buffer."""
+        curs.execute("SELECT active FROM current_states_pointer FOR UPDATE")
+        record = curs.fetchone()
+        active = record[0] if record else CURRENT_STATES_TABLES[1]
+        inactive = CURRENT_STATES_TABLES[0] if active == CURRENT_STATES_TABLES[1] else CURRENT_STATES_TABLES[1]
+        curs.execute(f"TRUNCATE {inactive}")
+        return inactive
+
+    @staticmethod
+    def _finish_current_states_swap(curs: cursor, table: str, request_time: int) -> None:
+        """Points the readers to the filled buffer, they see it once the transaction is committed.
+        Listeners of STATES_CHANNEL are notified at the same moment."""
+        curs.execute("UPDATE current_states_pointer SET active = %s, request_time = %s", (table, request_time))
+        curs.execute("SELECT pg_notify(%s, %s);", (STATES_CHANNEL, str(request_time)))
+
+    @_timed
     def insert_current_states(self, aircraft_states: List[StateVector]) -> None:
+        """The snapshot is written to the inactive buffer of current states which is published when it is complete."""
         with self.conn.cursor() as curs:
-            """Row deletion can be implemented either by DELETE or by TRUNCATE TABLE.
-            Though the DELETE option requires VACUUM to remove dead row versions,
-            it is still preferred in our context as TRUNCATE would violate MVCC semantics
-            and hinder parallel requests to access current states"""
-            curs.execute(f"DELETE FROM current_states;")
+            table = self._start_current_states_swap(curs)
 
             resp_time: int = getattr(aircraft_states[0], "request_time")
 
-            # aircraft_states = sorted(aircraft_states, key=lambda k: k.icao24)
-
+            columns_str, values_str = column_value_to_str(StateVector._fields)
+            insert_query = f"INSERT INTO {table} ({columns_str}) VALUES ({values_str}) ON CONFLICT DO NOTHING"
             for state in aircraft_states:
-                columns_str, values_str = column_value_to_str(state._fields)
-                row: Dict = state._asdict()
+                curs.execute(insert_query, state._asdict())
 
-                curs.execute(
-                    f"INSERT INTO current_states ({columns_str}) VALUES ({values_str}) " f"ON CONFLICT DO NOTHING",
-                    row,
-                )
+            self._finish_current_states_swap(curs, table, resp_time)
             logger.debug(f"Inserted {len(aircraft_states)} aircraft states for the timestamp {resp_time}")
 
+    @_timed
+    def copy_current_states(self, aircraft_states: List[StateVector]) -> None:
+        """Bulk counterpart of insert_current_states.
+        The whole snapshot is streamed with a single COPY FROM STDIN into the inactive buffer,
+        so the number of round trips does not depend on the number of states.
+        Duplicated icao24 are skipped before the COPY, the first state is kept as in the per-row path."""
+        columns_str = ", ".join(StateVector._fields)
+        seen = set()
+        unique_states = []
+        for state in aircraft_states:
+            if state.icao24 not in seen:
+                seen.add(state.icao24)
+                unique_states.append(state)
+
+        with self.conn.cursor() as curs:
+            table = self._start_current_states_swap(curs)
+            curs.copy_expert(f"COPY {table} ({columns_str}) FROM STDIN", rows_to_copy_buffer(unique_states))
+
+            resp_time: int = getattr(aircraft_states[0], "request_time")
+            self._finish_current_states_swap(curs, table, resp_time)
+            logger.debug(f"Copied {len(unique_states)} aircraft states for the timestamp {resp_time}")
+
+    @_timed
     def get_current_states(self) -> Optional[List[Dict]]:
+        table = self.get_current_states_table()
         with self.conn.cursor() as curs:
-            curs.execute("SELECT * FROM current_states")
+            curs.execute(f"SELECT * FROM {table}")
             aircraft_states = curs.fetchall()
             states = []
             if len(aircraft_states) != 0:
@@ -83,38 +210,90 @@ class DB:
             else:
                 return None
 
+    @_timed
     def insert_path(self, path: FlightPath) -> None:
         columns_str, values_str = column_value_to_str(path._fields)
         flight_path = path._asdict()
         with self.conn.cursor() as curs:
             curs.execute(f"INSERT INTO flight_paths ({columns_str}) VALUES ({values_str})", flight_path)
 
+    @_timed
     def delete_outdated_paths(self) -> None:
-        """A timestamp of a record was finished is compared to the current timestamp with time zone."""
+        """A timestamp of a record was finished is compared to the current timestamp with time zone.
+        It scans the whole table, partitions are dropped instead once flight_paths is partitioned."""
         with self.conn.cursor() as curs:
             curs.execute(
+                "WITH deleted AS ("
                 "DELETE FROM flight_paths "
-                "WHERE now() - to_timestamp(finished_at) > interval '5 days' AND finished_at != 0;"
+                "WHERE now() - to_timestamp(finished_at) > interval '5 days' AND finished_at != 0 "
+                "RETURNING path_id) "
+                "DELETE FROM flight_path_points WHERE path_id IN (SELECT path_id FROM deleted);"
             )
             logger.debug("deletion succeeded")
 
-    def update_paths_when_finished(self) -> None:
-        """Updates finished and finished_at columns of flight_paths for records with no update for more then 30 min."""
+    @_timed
+    def update_paths_when_finished(self, now: Optional[int] = None) -> None:
+        """Updates finished and finished_at columns of flight_paths for records with no update for more then 30 min.
+        The finished paths are found and removed in active_flights, flight_paths is addressed by path_id.
+        now is the current time by default, replays pass the time of the replayed snapshot."""
         with self.conn.cursor() as curs:
-            time_now = int(time.time())
+            time_now = int(time.time()) if now is None else now
             curs.execute(
-                f"UPDATE flight_paths SET finished = True, finished_at = %s WHERE finished = False "
-                f"AND %s - last_update > 1800",
+                "WITH finished AS ("
+                "DELETE FROM active_flights WHERE %s - last_update > 1800 RETURNING path_id, started_at) "
+                "UPDATE flight_paths SET finished = True, finished_at = %s "
+                "WHERE (path_id, started_at) IN (SELECT path_id, started_at FROM finished)",
                 (time_now, time_now),
             )
 
-    def upsert_callsigns(self, flights: List[OpenskyFlight]) -> None:
+    @_timed
+    def rebuild_active_flights(self) -> int:
+        """Fills active_flights with the unfinished paths of flight_paths. If an aircraft has several of them,
+        only the latest one stays unfinished. Returns the quantity of active flights."""
+        with self.conn.cursor() as curs:
+            time_now = int(time.time())
+            curs.execute("DELETE FROM active_flights")
+            curs.execute(
+                "INSERT INTO active_flights "
+                "(icao24, path_id, started_at, last_update, departure_airport_icao, arrival_airport_icao) "
+                "SELECT DISTINCT ON (icao24) icao24, path_id, started_at, last_update, departure_airport_icao, "
+                "arrival_airport_icao FROM flight_paths WHERE finished = False ORDER BY icao24, last_update DESC"
+            )
+            active = curs.rowcount
+            curs.execute(
+                "UPDATE flight_paths AS fp SET finished = True, finished_at = %s WHERE fp.finished = False "
+                "AND NOT EXISTS (SELECT 1 FROM active_flights AS af WHERE af.path_id = fp.path_id)",
+                (time_now,),
+            )
+            return active
+
+    @_timed
+    def upsert_callsigns(self, flights: List[OpenskyFlight], chunk_size: int = 1000) -> None:
+        """Callsigns are deduplicated beforehand, the last seen flight wins.
+        They are written by chunks of chunk_size rows, the records which have not changed are left untouched.
+        Listeners of CALLSIGNS_CHANNEL are notified when the transaction is committed."""
+        memo: Dict[str, Tuple[str, str]] = {}
         for flight in flights:
             if flight.callsign is not None:
-                self.upsert_one_callsign(
-                    flight.callsign.strip().upper(), flight.estArrivalAirport, flight.estDepartureAirport
-                )
+                memo[flight.callsign.strip().upper()] = (flight.estArrivalAirport, flight.estDepartureAirport)
+        records = [(callsign, arr_airp, dep_airp) for callsign, (arr_airp, dep_airp) in memo.items()]
 
+        with self.conn.cursor() as curs:
+            extras.execute_values(
+                curs,
+                "INSERT INTO callsign_memo (callsign, est_arrival_airport, est_departure_airport) VALUES %s "
+                "ON CONFLICT (callsign) DO UPDATE "
+                "SET est_arrival_airport = EXCLUDED.est_arrival_airport, "
+                "est_departure_airport = EXCLUDED.est_departure_airport "
+                "WHERE callsign_memo.est_arrival_airport IS DISTINCT FROM EXCLUDED.est_arrival_airport "
+                "OR callsign_memo.est_departure_airport IS DISTINCT FROM EXCLUDED.est_departure_airport",
+                records,
+                page_size=chunk_size,
+            )
+        logger.debug(f"Upserted {len(records)} callsigns from {len(flights)} flights")
+        self.notify(CALLSIGNS_CHANNEL)
+
+    @_timed
     def upsert_one_callsign(self, callsign: str, arrival_airport: str, departure_airport: str) -> None:
         with self.conn.cursor() as curs:
             curs.execute(f"SELECT * FROM callsign_memo WHERE callsign = %s", (callsign,))
@@ -140,17 +319,61 @@ class DB:
     #         arr_airport = curs.fetchone()
     #         return arr_airport
 
+    @_timed
     def find_unfinished_path_for_aircraft(self, icao: str) -> Optional[Dict]:
         with self.conn.cursor() as curs:
-            curs.execute("SELECT * FROM flight_paths WHERE icao24 = %s AND finished = False", (icao,))
+            curs.execute(
+                f"SELECT {FLIGHT_PATH_COLUMNS} FROM active_flights AS af "
+                "JOIN flight_paths AS fp ON fp.path_id = af.path_id AND fp.started_at = af.started_at "
+                "WHERE af.icao24 = %s",
+                (icao,),
+            )
             record = curs.fetchone()
             if record:
-                record = record[1:]
                 path = FlightPath(*record)._asdict()
                 return path
             else:
                 return None
 
+    @_timed
+    def get_unfinished_path_points(
+        self, icao: str, after_point_id: Optional[int] = None
+    ) -> Optional[Tuple[Dict, List[Tuple[int, float, float]]]]:
+        """Returns the unfinished path of the aircraft without its points along with (point_id, longitude, latitude)
+        of the points appended after after_point_id, or of all its points if it is None. The points of the legacy
+        JSONB path have point_id 0, they are returned only with all the points."""
+        with self.conn.cursor() as curs:
+            curs.execute(
+                "SELECT af.path_id, af.last_update, af.icao24, fp.callsign, af.departure_airport_icao, "
+                "af.arrival_airport_icao, fp.path "
+                "FROM active_flights AS af JOIN flight_paths AS fp "
+                "ON fp.path_id = af.path_id AND fp.started_at = af.started_at WHERE af.icao24 = %s",
+                (icao,),
+            )
+            record = curs.fetchone()
+            if record is None:
+                return None
+            path_id, last_update, icao24, callsign, dep_airp, arr_airp, legacy_path = record
+            flight = {
+                "path_id": path_id,
+                "last_update": last_update,
+                "icao24": icao24,
+                "callsign": callsign,
+                "departure_airport_icao": dep_airp,
+                "arrival_airport_icao": arr_airp,
+            }
+
+            points: List[Tuple[int, float, float]] = []
+            if after_point_id is None and legacy_path:
+                points = [(0, point["longitude"], point["latitude"]) for point in legacy_path]
+            curs.execute(
+                "SELECT point_id, longitude, latitude FROM flight_path_points "
+                "WHERE path_id = %s AND point_id > %s ORDER BY point_id",
+                (path_id, after_point_id or 0),
+            )
+            points.extend(curs.fetchall())
+            return flight, points
+
     # def get_airport_long_lat(self, airport_icao: str) -> Tuple[float, float]:
     #     with self.conn.cursor() as curs:
     #         curs.execute(
@@ -159,6 +382,7 @@ class DB:
     #         longitude, latitude = curs.fetchone()
     #     return longitude, latitude
 
+    @_timed
     def get_airports_for_callsign(self, callsign: str) -> Optional[Tuple[str, str]]:
         with self.conn.cursor() as curs:
             curs.execute(
@@ -172,108 +396,254 @@ class DB:
             else:
                 return None
 
-    def update_unfinished_path(
-        self, icao: str, old_last_update: int, path_travelled: str, new_last_update: int, arr_airp: str, dep_airp: str
-    ) -> None:
+    @_timed
+    def get_all_callsign_airports(self) -> Dict[str, Tuple[str, str]]:
         with self.conn.cursor() as curs:
-            if arr_airp is None and dep_airp is None:
-                curs.execute(
-                    "UPDATE flight_paths "
-                    "SET path = path::jsonb || %s::jsonb, last_update = %s "
-                    "WHERE icao24 = %s AND last_update = %s",
-                    (path_travelled, new_last_update, icao, old_last_update),
-                )
-            else:
-                curs.execute(
-                    "UPDATE flight_paths "
-                    "SET path = path::jsonb || %s::jsonb, last_update = %s, "
-                    "departure_airport_icao = %s, arrival_airport_icao = %s "
-                    "WHERE icao24 = %s AND last_update = %s",
-                    (path_travelled, new_last_update, dep_airp, arr_airp, icao, old_last_update),
-                )
-
-    def delete_outdated_stats(self) -> None:
+            curs.execute("SELECT callsign, est_arrival_airport, est_departure_airport FROM callsign_memo")
+            memo = curs.fetchall()
+            return {callsign: (arr_airp, dep_airp) for callsign, arr_airp, dep_airp in memo}
+
+    @_timed
+    def append_current_states_to_paths(self) -> int:
+        """Appends the current location of every aircraft to its unfinished path in a single statement.
+        Unfinished paths are looked up in active_flights, points are inserted into flight_path_points
+        and the row of the path is updated by its path_id. Airports are taken from callsign_memo
+        and replace the known ones only if at least one of them is present. Returns the quantity of updated paths."""
+        table = self.get_current_states_table()
         with self.conn.cursor() as curs:
-            curs.execute("DELETE FROM airport_stats " "WHERE now() - the_date > interval '1 month' ")
+            curs.execute(
+                f"WITH moved AS ("
+                "UPDATE active_flights AS af "
+                "SET last_update = cs.request_time, "
+                "departure_airport_icao = CASE WHEN cm.est_arrival_airport IS NULL "
+                "AND cm.est_departure_airport IS NULL THEN af.departure_airport_icao "
+                "ELSE cm.est_departure_airport END, "
+                "arrival_airport_icao = CASE WHEN cm.est_arrival_airport IS NULL "
+                "AND cm.est_departure_airport IS NULL THEN af.arrival_airport_icao "
+                "ELSE cm.est_arrival_airport END "
+                f"FROM {table} AS cs "
+                "LEFT JOIN callsign_memo AS cm ON cm.callsign = UPPER(TRIM(cs.callsign)) "
+                "WHERE af.icao24 = cs.icao24 AND af.last_update < cs.request_time "
+                "RETURNING af.path_id, af.started_at, af.last_update, "
+                "af.departure_airport_icao, af.arrival_airport_icao, "
+                "cs.longitude, cs.latitude, cs.baro_altitude), "
+                "updated AS ("
+                "UPDATE flight_paths AS fp SET last_update = moved.last_update, "
+                "departure_airport_icao = moved.departure_airport_icao, "
+                "arrival_airport_icao = moved.arrival_airport_icao "
+                "FROM moved WHERE fp.path_id = moved.path_id AND fp.started_at = moved.started_at) "
+                "INSERT INTO flight_path_points (path_id, ts, longitude, latitude, altitude) "
+                "SELECT path_id, last_update, longitude, latitude, baro_altitude FROM moved"
+            )
+            return curs.rowcount
 
-    def update_stats_for_arrival_airport(self, airport: str, day: str) -> None:
+    @_timed
+    def insert_paths_for_new_aircraft(self) -> int:
+        """Starts a path for every aircraft from current_states which is not in active_flights yet
+        and adds it there. Returns the quantity of inserted paths."""
+        table = self.get_current_states_table()
         with self.conn.cursor() as curs:
             curs.execute(
-                "UPDATE airport_stats "
-                "SET airplane_quantity_arrivals = airplane_quantity_arrivals + 1"
-                "WHERE airport_icao = %s AND the_date = %s",
-                (airport, day),
+                f"WITH started AS ("
+                "INSERT INTO flight_paths (started_at, last_update, icao24, callsign, departure_airport_icao, "
+                "arrival_airport_icao, finished, finished_at) "
+                "SELECT cs.request_time, cs.request_time, cs.icao24, cs.callsign, "
+                "cm.est_departure_airport, cm.est_arrival_airport, False, 0 "
+                f"FROM {table} AS cs "
+                "LEFT JOIN callsign_memo AS cm ON cm.callsign = UPPER(TRIM(cs.callsign)) "
+                "WHERE NOT EXISTS (SELECT 1 FROM active_flights AS af WHERE af.icao24 = cs.icao24) "
+                "ON CONFLICT DO NOTHING "
+                "RETURNING path_id, started_at, last_update, icao24, departure_airport_icao, arrival_airport_icao), "
+                "activated AS ("
+                "INSERT INTO active_flights "
+                "(icao24, path_id, started_at, last_update, departure_airport_icao, arrival_airport_icao) "
+                "SELECT icao24, path_id, started_at, last_update, departure_airport_icao, arrival_airport_icao "
+                "FROM started) "
+                "INSERT INTO flight_path_points (path_id, ts, longitude, latitude, altitude) "
+                "SELECT started.path_id, cs.request_time, cs.longitude, cs.latitude, cs.baro_altitude "
+                f"FROM started JOIN {table} AS cs ON cs.icao24 = started.icao24"
             )
+            return curs.rowcount
 
-    def update_stats_for_departure_airport(self, airport: str, day: str) -> None:
+    def get_unmoved_paths_span(self) -> Optional[Tuple[int, int]]:
+        """Returns the earliest and the latest start of the JSONB paths which move_paths_to_points would move"""
+        with self.conn.cursor() as curs:
+            curs.execute(
+                "SELECT MIN(COALESCE(started_at, last_update)), MAX(COALESCE(started_at, last_update)) "
+                "FROM flight_paths AS fp WHERE path IS NOT NULL "
+                "AND NOT EXISTS (SELECT 1 FROM flight_path_points AS p WHERE p.path_id = fp.path_id)"
+            )
+            first, last = curs.fetchone()
+            return None if first is None else (first, last)
+
+    def move_paths_to_points(self) -> int:
+        """Moves the JSONB paths of flight_paths to flight_path_points, keeping the order of their points.
+        The points have no time of their own, they are all stamped with the start of their path, so
+        flight_path_points should have the partitions of the days given by get_unmoved_paths_span.
+        The paths which already have points in flight_path_points are left as they are,
+        their JSONB part is read before the points anyway. Returns the quantity of moved paths."""
         with self.conn.cursor() as curs:
             curs.execute(
-                "UPDATE airport_stats "
-                "SET airplane_quantity_departures = airplane_quantity_departures + 1"
-                "WHERE airport_icao = %s AND the_date = %s",
-                (airport, day),
+                "WITH moved AS ("
+                "SELECT path_id, COALESCE(started_at, last_update) AS ts, path FROM flight_paths AS fp "
+                "WHERE path IS NOT NULL "
+                "AND NOT EXISTS (SELECT 1 FROM flight_path_points AS p WHERE p.path_id = fp.path_id) "
+                "FOR UPDATE), "
+                "inserted AS ("
+                "INSERT INTO flight_path_points (path_id, ts, longitude, latitude) "
+                "SELECT moved.path_id, moved.ts, (point ->> 'longitude')::DOUBLE PRECISION, "
+                "(point ->> 'latitude')::DOUBLE PRECISION "
+                "FROM moved CROSS JOIN LATERAL jsonb_array_elements(moved.path) WITH ORDINALITY AS points(point, n) "
+                "ORDER BY moved.path_id, points.n) "
+                "UPDATE flight_paths SET path = NULL WHERE path_id IN (SELECT path_id FROM moved)"
             )
+            return curs.rowcount
 
-    def get_stats_for_airport(self, airport: str, update_day: str) -> Optional[AirportStats]:
+    @_timed
+    def delete_outdated_stats(self) -> None:
+        """It is used only until airport_stats is partitioned, partitions are dropped instead then."""
         with self.conn.cursor() as curs:
-            curs.execute("SELECT * FROM airport_stats WHERE airport_icao = %s AND the_date = %s", (airport, update_day))
-            stats = curs.fetchone()
-            if stats:
-                stats = AirportStats(*stats[1:])
-                return stats
-            return None
+            curs.execute("DELETE FROM airport_stats " "WHERE now() - the_date > interval '1 month' ")
 
-    def insert_arrival_airport_stats(self, airport_icao: str, day: str) -> None:
+    def is_partitioned(self, table: str) -> bool:
         with self.conn.cursor() as curs:
-            new_stats = AirportStats(
-                airport_icao=airport_icao,
-                the_date=day,
-                airplane_quantity_arrivals=1,
-                airplane_quantity_departures=0,
+            curs.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,)
             )
-            stats = new_stats._asdict()
+            return curs.fetchone()[0]
 
-            columns_str, values_str = column_value_to_str(new_stats._fields)
+    def get_day_partitions(self, table: str) -> Dict[date, str]:
+        """Returns the partitions of the table named as {table}_YYYYMMDD by their day."""
+        with self.conn.cursor() as curs:
             curs.execute(
-                f"INSERT INTO airport_stats ({columns_str})" f"VALUES ({values_str})",
-                stats,
+                "SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(%s)",
+                (table,),
             )
-
-    def insert_departure_airport_stats(self, airport_icao: str, day: str) -> None:
+            partitions = {}
+            for (name,) in curs.fetchall():
+                try:
+                    partitions[datetime.strptime(name[len(table) + 1 :], "%Y%m%d").date()] = name
+                except ValueError:
+                    continue
+            return partitions
+
+    @_timed
+    def create_day_partitions(self, table: str, first_day: date, days: int) -> List[str]:
+        """Creates the missing partitions of the table for the days since first_day. Returns their names."""
+        existing = self.get_day_partitions(table)
+        created = []
         with self.conn.cursor() as curs:
-            new_stats = AirportStats(
-                airport_icao=airport_icao,
-                the_date=day,
-                airplane_quantity_arrivals=0,
-                airplane_quantity_departures=1,
+            for offset in range(days):
+                day = first_day + timedelta(days=offset)
+                if day in existing:
+                    continue
+                name = f"{table}_{day:%Y%m%d}"
+                if table in DATE_PARTITIONED_TABLES:
+                    bounds: Tuple = (day, day + timedelta(days=1))
+                else:
+                    start = calendar.timegm(day.timetuple())
+                    bounds = (start, start + 86400)
+                curs.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", bounds
+                )
+                created.append(name)
+        return created
+
+    @_timed
+    def drop_day_partitions(self, table: str, before: date) -> List[str]:
+        """Detaches and drops the partitions of the table for the days before the given one. Returns their names.
+        Unlike a DELETE, it touches no rows and leaves nothing to vacuum."""
+        dropped = []
+        with self.conn.cursor() as curs:
+            for day, name in sorted(self.get_day_partitions(table).items()):
+                if day >= before:
+                    break
+                if table == "flight_paths":
+                    start = calendar.timegm(day.timetuple())
+                    curs.execute(
+                        "DELETE FROM active_flights WHERE started_at >= %s AND started_at < %s", (start, start + 86400)
+                    )
+                curs.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                curs.execute(f"DROP TABLE {name}")
+                dropped.append(name)
+        return dropped
+
+    @_timed
+    def add_finished_paths_to_stats(self, last_update: int, first_day: Optional[date] = None) -> int:
+        """Counts the paths finished after last_update in arrivals and departures of their airports.
+        The deltas are aggregated per airport and day of the last path update in a single statement,
+        the path column is never read. Every flight is counted once, as finished_at is set only once.
+        The paths last updated before first_day are left out, the stats of their days are no longer kept.
+        The partitions of the other days are created if they are missing, after a downtime for instance.
+        Returns the new value of last_update."""
+        since = calendar.timegm(first_day.timetuple()) if first_day else 0
+        with self.conn.cursor() as curs:
+            curs.execute(
+                "SELECT MAX(finished_at) FROM flight_paths WHERE finished = True AND finished_at > %s;",
+                (last_update,),
             )
-            stats = new_stats._asdict()
+            max_update = curs.fetchone()[0]
+            if max_update is None:
+                return last_update
+
+            if self.is_partitioned("airport_stats"):
+                curs.execute(
+                    "SELECT MIN(last_update), MAX(last_update) FROM flight_paths "
+                    "WHERE finished = True AND finished_at > %s AND finished_at <= %s AND last_update >= %s",
+                    (last_update, max_update, since),
+                )
+                first, last = curs.fetchone()
+                if first is not None:
+                    first_date = datetime.utcfromtimestamp(first).date()
+                    days = (datetime.utcfromtimestamp(last).date() - first_date).days + 1
+                    self.create_day_partitions("airport_stats", first_date, days)
 
-            columns_str, values_str = column_value_to_str(new_stats._fields)
             curs.execute(
-                f"INSERT INTO airport_stats ({columns_str})" f"VALUES ({values_str})",
-                stats,
+                "INSERT INTO airport_stats "
+                "(airport_icao, the_date, airplane_quantity_arrivals, airplane_quantity_departures) "
+                "SELECT airport_icao, the_date, SUM(arrivals), SUM(departures) FROM ("
+                "SELECT arrival_airport_icao AS airport_icao, "
+                "(to_timestamp(last_update) AT TIME ZONE 'UTC')::date AS the_date, 1 AS arrivals, 0 AS departures "
+                "FROM flight_paths WHERE finished = True AND finished_at > %(last_update)s "
+                "AND finished_at <= %(max_update)s AND last_update >= %(since)s AND arrival_airport_icao IS NOT NULL "
+                "UNION ALL "
+                "SELECT departure_airport_icao, "
+                "(to_timestamp(last_update) AT TIME ZONE 'UTC')::date, 0, 1 "
+                "FROM flight_paths WHERE finished = True AND finished_at > %(last_update)s "
+                "AND finished_at <= %(max_update)s AND last_update >= %(since)s AND departure_airport_icao IS NOT NULL"
+                ") AS deltas GROUP BY airport_icao, the_date "
+                "ON CONFLICT (airport_icao, the_date) DO UPDATE SET "
+                "airplane_quantity_arrivals = airport_stats.airplane_quantity_arrivals "
+                "+ EXCLUDED.airplane_quantity_arrivals, "
+                "airplane_quantity_departures = airport_stats.airplane_quantity_departures "
+                "+ EXCLUDED.airplane_quantity_departures",
+                {"last_update": last_update, "max_update": max_update, "since": since},
             )
+            logger.debug(f"Stats of {curs.rowcount} airport days updated with paths finished till {max_update}")
+            return max_update
 
+    @_timed
     def update_airport_stats_last_update(self, last_update: int) -> None:
         with self.conn.cursor() as curs:
             curs.execute(f"INSERT INTO airport_stats_last_update (last_stats_update_time) VALUES (%s)", (last_update,))
 
+    @_timed
     def get_stats_last_update(self) -> int:
+        """Returns the finished_at of the latest path counted in the stats. The rows written before the stats
+        were counted by finished_at hold a last_update and are left out, make-tables starts the watermark
+        from the paths finished by the time it migrates the table."""
         with self.conn.cursor() as curs:
-            curs.execute("SELECT MAX(last_stats_update_time) FROM airport_stats_last_update;")
+            curs.execute(
+                "SELECT MAX(last_stats_update_time) FROM airport_stats_last_update WHERE watermark = 'finished_at';"
+            )
             last_update = curs.fetchone()[0]
             if last_update:
                 return last_update
             else:
                 return 0
 
-    def get_not_considered_paths(self, last_update: int) -> List[Tuple]:
-        with self.conn.cursor() as curs:
-            curs.execute("SELECT * FROM flight_paths WHERE last_update > %s;", (last_update,))
-            paths = curs.fetchall()
-            return paths
-
+    @_timed
     def get_all_airports(self) -> Optional[List[Dict]]:
         with self.conn.cursor() as curs:
             curs.execute("SELECT * FROM airports;")
@@ -286,18 +656,50 @@ class DB:
             else:
                 return None
 
+    @_timed
     def get_all_paths_for_icao(self, icao: str) -> Optional[List[Dict]]:
         with self.conn.cursor() as curs:
-            curs.execute("SELECT * FROM flight_paths " "WHERE icao24 = %s", (icao,))
+            curs.execute(f"SELECT {FLIGHT_PATH_COLUMNS} FROM flight_paths AS fp WHERE icao24 = %s", (icao,))
             response = curs.fetchall()
             flights = []
             if response:
                 for flight in response:
-                    flights.append(FlightPath(*flight[1:])._asdict())
+                    flights.append(FlightPath(*flight)._asdict())
                 return flights
             else:
                 return None
 
+    def get_table_stats(self) -> List[Dict]:
+        """Returns live and dead rows and the size with indexes of the tables, partitions included.
+        Row counts come from the statistics collector, so they lag behind a bit."""
+        with self.conn.cursor() as curs:
+            curs.execute(
+                "SELECT relname, n_live_tup, n_dead_tup, pg_total_relation_size(relid) FROM pg_stat_user_tables "
+                "ORDER BY relname"
+            )
+            return [
+                {"table": table, "live_rows": live, "dead_rows": dead, "total_bytes": size}
+                for table, live, dead, size in curs.fetchall()
+            ]
+
+    def listen(self, channel: str) -> None:
+        """Subscribes the connection to the channel. It takes effect when the transaction is committed."""
+        with self.conn.cursor() as curs:
+            curs.execute(f"LISTEN {channel};")
+
+    def notify(self, channel: str, payload: str = "") -> None:
+        """Notifications are delivered to listeners when the transaction is committed."""
+        with self.conn.cursor() as curs:
+            curs.execute("SELECT pg_notify(%s, %s);", (channel, payload))
+
+    def pop_notifications(self) -> List[Tuple[str, str]]:
+        """Returns (channel, payload) of notifications received since the last call.
+        Notifications arrive only between transactions, so it should be called outside of them."""
+        self.conn.poll()
+        notifications = [(notify.channel, notify.payload) for notify in self.conn.notifies]
+        del self.conn.notifies[:]
+        return notifications
+
     def execute_script(self, script: str) -> None:
         with self.conn:
             with self.conn.cursor() as curs:
@@ -0,0 +1,29 @@
+from typing import Any
+
+from psycopg2 import OperationalError, extensions
+
+
+def eventlet_wait_callback(conn: Any, timeout: int = -1) -> None:
+    """Waits for the results of a query by yielding to the eventlet hub instead of blocking in libpq"""
+    from eventlet.hubs import trampoline
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+def patch_psycopg() -> None:
+    """Makes the queries of all connections cooperative, so that a slow query suspends only its greenlet.
+    COPY can not be used with a wait callback, so it is only for the processes which do not ingest."""
+    extensions.set_wait_callback(eventlet_wait_callback)
+
+
+def unpatch_psycopg() -> None:
+    extensions.set_wait_callback(None)
@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from psycopg2 import Error, extensions
+
+from aviatracker.database.database import DB
+
+
+logger = logging.getLogger()
+
+
+class PoolTimeout(Exception):
+    """No connection of the pool has become free in time"""
+
+
+class DBPool:
+    """Bounded pool of DB connections.
+    It relies only on the threading primitives, which become green after eventlet.monkey_patch(),
+    so one pool can be shared by the threads of a Celery worker as well as by the greenlets of the web app.
+    An idle connection is checked with SELECT 1 before it is handed out, if it has not been used for
+    health_check_interval seconds."""
+
+    def __init__(self, params: Dict[str, Any], max_size: int = 4, health_check_interval: int = 30) -> None:
+        self.params = params
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle: List[Tuple[DB, float]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[DB]:
+        """Checks out a connection, waits for a free one up to timeout seconds or for as long as it takes"""
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolTimeout(f"no connection has been free for {timeout} seconds")
+        try:
+            db = self._checkout()
+            try:
+                yield db
+            finally:
+                self._checkin(db)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db, _ in idle:
+            db.close()
+
+    def _checkout(self) -> DB:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                db, last_used = self._idle.pop()
+            if db.conn.closed:
+                continue
+            if time.monotonic() - last_used < self.health_check_interval or db.is_alive():
+                return db
+            logger.warning("A pooled connection to the database has failed the health check")
+            db.close()
+        return DB(**self.params)
+
+    def _checkin(self, db: DB) -> None:
+        if db.conn.closed:
+            return
+        if db.conn.status != extensions.STATUS_READY:
+            try:
+                db.conn.rollback()
+            except Error:
+                db.close()
+                return
+        with self._lock:
+            self._idle.append((db, time.monotonic()))
+
+
+_pools: Dict[Tuple[int, Tuple], DBPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(params: Dict[str, Any]) -> DBPool:
+    """Returns the pool for the params which belongs to the current process.
+    Connections can not be shared with forked processes, so every process gets its own pool."""
+    key = (os.getpid(), tuple(sorted(params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = DBPool(params)
+        return _pools[key]
+
+
+@contextmanager
+def pooled_db(params: Dict[str, Any], timeout: Optional[float] = None) -> Iterator[DB]:
+    with get_pool(params).connection(timeout) as db:
+        yield db
@@ -1,7 +1,27 @@
-from typing import List, Tuple
+import io
+from typing import Any, Iterable, List, Tuple
 
 
 def column_value_to_str(fields: Tuple) -> List[str]:
     columns_str: str = ", ".join(fields)
     values_str: str = ",".join([f"%({field})s" for field in fields])
     return [columns_str, values_str]
+
+
+_copy_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_value_to_str(value: Any) -> str:
+    """Formats a value as a field of the COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(_copy_escapes)
+
+
+def rows_to_copy_buffer(rows: Iterable[Tuple]) -> io.StringIO:
+    """Serializes rows into a buffer which can be passed to COPY ... FROM STDIN."""
+    lines = ["\t".join([copy_value_to_str(value) for value in row]) for row in rows]
+    buffer = io.StringIO("\n".join(lines) + "\n" if lines else "")
+    return buffer
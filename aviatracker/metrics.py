@@ -0,0 +1,245 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PORT_VARIABLE = "AVIATRACKER_METRICS_PORT"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Registry:
+    """Metrics of the process, they are exposed in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self._metrics: List["Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric") -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def exposition(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """A metric with its values per combination of label values.
+    The methods of the metric itself are shortcuts for the metric without labels."""
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), registry: Optional[Registry] = None
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], "Value"] = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str) -> "Value":
+        key = tuple(str(value) for value in values)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = self._new_value()
+            return value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = []
+        for key, value in values:
+            for suffix, extra_labels, number in value.samples():
+                names = self.labelnames + tuple(name for name, _ in extra_labels)
+                label_values = key + tuple(label for _, label in extra_labels)
+                lines.append(f"{self.name}{suffix}{_format_labels(names, label_values)} {_format_value(number)}")
+        return lines
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """Returns the values of a counter or a gauge by their label values"""
+        with self._lock:
+            return {key: value.value for key, value in self._values.items()}
+
+    def _new_value(self) -> "Value":
+        return Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, number: float) -> None:
+        self.labels().set(number)
+
+    def observe(self, number: float) -> None:
+        self.labels().observe(number)
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        with self.labels().time():
+            yield
+
+
+class Value:
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, number: float) -> None:
+        with self._lock:
+            self.value = number
+
+    def observe(self, number: float) -> None:
+        raise TypeError("only histograms observe values")
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        return [("", (), self.value)]
+
+
+class HistogramValue(Value):
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        super().__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, number: float) -> None:
+        with self._lock:
+            self.sum += number
+            for index, bound in enumerate(self.buckets):
+                if number <= bound:
+                    self.counts[index] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples: List[Tuple[str, Tuple[Tuple[str, str], ...], float]] = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(("_bucket", (("le", _format_value(bound)),), cumulative))
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+        registry: Optional[Registry] = None,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self) -> Value:
+        return HistogramValue(self.buckets)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer of Python 3.7, the image runs Python 3.6"""
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        payload = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logger.debug(f"metrics: {format % args}")
+
+
+def start_http_server(port: int, addr: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serves the metrics of the process on any path from a daemon thread"""
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Metrics are served on {addr}:{port}")
+    return server
+
+
+def start_http_server_from_env() -> Optional[ThreadingHTTPServer]:
+    """Starts the metrics server on the port from AVIATRACKER_METRICS_PORT, if it is set"""
+    port = os.environ.get(PORT_VARIABLE)
+    if not port:
+        return None
+    return start_http_server(int(port))
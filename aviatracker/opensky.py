@@ -1,58 +1,164 @@
 import json
 import logging
+import random
 import socket
-from typing import Dict, List, Optional
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 import time
 
-from requests import exceptions, get, codes
+from requests import Response, Session, adapters, exceptions, codes
 
-from aviatracker.config import common_conf
 from aviatracker.database import FlightAirportInfo, StateVector, OpenskyFlight
+from aviatracker.metrics import Counter, Histogram
+from aviatracker.recording import ResponseRecorder
 
 logger = logging.getLogger()
 
+OPENSKY_SECONDS = Histogram("aviatracker_opensky_request_seconds", "Latency of OpenSky API requests", ("operation",))
+OPENSKY_BYTES = Histogram(
+    "aviatracker_opensky_response_bytes",
+    "Decompressed size of successful OpenSky API responses",
+    ("operation",),
+    buckets=(1e4, 1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2e7),
+)
+OPENSKY_REQUESTS = Counter("aviatracker_opensky_requests_total", "OpenSky API requests", ("operation", "status"))
+
+# positions in a state of /states/all, the state starts from icao24 and lacks the request_time of StateVector
+LAST_CONTACT, LONGITUDE, LATITUDE = 4, 5, 6
+FLOAT_COLUMNS = {"longitude": 5, "latitude": 6, "baro_altitude": 7, "velocity": 9, "true_track": 10}
+STATE_SIZE = len(StateVector._fields) - 1
+
+
+class DecodedStates(NamedTuple):
+    """States of a /states/all response left after decoding, both as StateVector and as columns.
+    Float columns hold NaN in place of the missing values."""
+
+    request_time: int
+    vectors: List[StateVector]
+    columns: Dict[str, array]
+    no_position: int
+    stale: int
+
+
+def decode_states(request_time: int, raw_states: List[List], max_age: int = 60) -> DecodedStates:
+    """Decodes the states in one pass. The states without position or with last_contact older than max_age seconds
+    before request_time are dropped, they would only add meaningless points to the paths."""
+    vectors = []
+    columns: Dict[str, array] = {name: array("d") for name in FLOAT_COLUMNS}
+    last_contacts = array("q")
+    appends = [(columns[name].append, index) for name, index in FLOAT_COLUMNS.items()]
+    nan = float("nan")
+    no_position = stale = 0
+    oldest = request_time - max_age
+
+    for state in raw_states:
+        if state[LONGITUDE] is None or state[LATITUDE] is None:
+            no_position += 1
+            continue
+        last_contact = state[LAST_CONTACT]
+        if last_contact is None or last_contact < oldest:
+            stale += 1
+            continue
+        vectors.append(StateVector(request_time, *state[:STATE_SIZE]))
+        last_contacts.append(last_contact)
+        for append, index in appends:
+            value = state[index]
+            append(nan if value is None else value)
+
+    columns["last_contact"] = last_contacts
+    return DecodedStates(request_time, vectors, columns, no_position, stale)
+
 
 class Opensky(object):
-    def __init__(self, username: Optional[str] = None, password: Optional[str] = None) -> None:
+    """Client of the OpenSky REST API.
+    Connections are kept alive in the session of the client, so an instance should be reused between requests.
+    Failed requests are retried with a jittered exponential backoff, the delay requested by OpenSky
+    in the rate limit headers is respected unless it is longer than max_backoff."""
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        api_url: str = "https://opensky-network.org/api",
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        pool_size: int = 8,
+        max_state_age: int = 60,
+        recorder: Optional[ResponseRecorder] = None,
+    ) -> None:
         if username is None or password is None:
+            from aviatracker.config import common_conf
+
             username, password = common_conf.opensky_user, common_conf.opensky_pass
         self.auth = (username, password)
-        self.api_url = "https://opensky-network.org/api"
+        self.api_url = api_url
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_state_age = max_state_age
+        self.recorder = recorder
 
-    def get_from_opensky(self, params: Dict, operation: str, timeout: int) -> Optional[Dict]:
-        try:
-            r = get(
-                "{}{}".format(self.api_url, operation),
-                auth=self.auth,
-                params=params,  # type: ignore
-                timeout=timeout,
-            )
-            if r.status_code == codes.ok:
-                logger.info("Successful connection to Opensky API.")
-                response = json.loads(r.text)
-                return response
-            else:
-                logger.error(f"Could not connect to Opensky API. Status code is {r.status_code}.")
-                return None
-
-        except (OSError, exceptions.ReadTimeout, socket.timeout) as e:
-            logger.error(f"Could not get data from API {operation} endpoint: {e}. ")
+        self.session = Session()
+        self.session.auth = self.auth
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self.session.mount("https://", adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("http://", adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def get_from_opensky(self, params: Dict, operation: str, timeout: int) -> Optional[Any]:
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                r = self.session.get("{}{}".format(self.api_url, operation), params=params, timeout=timeout)
+                OPENSKY_SECONDS.labels(operation).observe(time.perf_counter() - start)
+                OPENSKY_REQUESTS.labels(operation, str(r.status_code)).inc()
+                if r.status_code == codes.ok:
+                    logger.info("Successful connection to Opensky API.")
+                    self._log_rate_limit(r)
+                    OPENSKY_BYTES.labels(operation).observe(len(r.content))
+                    response = json.loads(r.content)
+                    self._record(operation, params, response, r.content)
+                    return response
+                elif r.status_code in self.retry_statuses:
+                    logger.warning(f"Opensky API {operation} endpoint responded with status code {r.status_code}.")
+                    delay = self._retry_delay(r, attempt)
+                else:
+                    logger.error(f"Could not connect to Opensky API. Status code is {r.status_code}.")
+                    return None
+
+            except (OSError, exceptions.ReadTimeout, socket.timeout, ValueError) as e:
+                OPENSKY_REQUESTS.labels(operation, "error").inc()
+                logger.error(f"Could not get data from API {operation} endpoint: {e}. ")
+                delay = self._backoff_delay(attempt)
+
+            if attempt == self.retries or delay > self.max_backoff:
+                break
+            time.sleep(delay)
+        return None
+
+    def get_current_states(self, time_sec: int = 0, icao24: Optional[str] = None) -> Optional[List[StateVector]]:
+        decoded = self.get_decoded_states(time_sec, icao24)
+        if decoded is not None and decoded.vectors:
+            return decoded.vectors
+        else:
             return None
 
-    def get_current_states(self, time_sec: int = 0, icao24: str = None) -> Optional[List[StateVector]]:
+    def get_decoded_states(self, time_sec: int = 0, icao24: Optional[str] = None) -> Optional[DecodedStates]:
         parameters = {"time": int(time_sec), "icao24": icao24}
         operation = "/states/all"
 
         resp: Optional[Dict] = self.get_from_opensky(parameters, operation, 15)
 
-        if resp is not None:
-            request_time = resp["time"]
-            dirty_states = resp["states"]
-            if dirty_states:
-                states = [StateVector(*([request_time] + state)) for state in dirty_states]
-                return states
-            else:
-                return None
+        if resp is not None and resp["states"]:
+            decoded = decode_states(resp["time"], resp["states"], self.max_state_age)
+            logger.debug(
+                f"{len(decoded.vectors)} states decoded, {decoded.no_position} without position "
+                f"and {decoded.stale} stale dropped"
+            )
+            return decoded
         else:
             return None
 
@@ -62,10 +168,47 @@ class Opensky(object):
         parameters = {"begin": begin, "end": end}
         operation = "/flights/all"
 
-        resp: Optional[Dict] = self.get_from_opensky(parameters, operation, 35)
+        resp: Optional[List[Dict]] = self.get_from_opensky(parameters, operation, 35)
 
         if resp is not None:
             flights = [OpenskyFlight(**x) for x in resp]
             return flights
         else:
             return None
+
+    def get_flights_for_periods(
+        self, begins: List[int], period: int = 3600, workers: int = 4
+    ) -> List[Tuple[int, Optional[List[OpenskyFlight]]]]:
+        """Gets flights history for several intervals at once, returns (begin, flights) in the order of begins"""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda begin: self.get_flights_for_period(begin, period), begins)
+            return list(zip(begins, results))
+
+    def _record(self, operation: str, params: Dict, response: Any, body: bytes) -> None:
+        """The states are recorded by their request_time, the flights by the beginning of their period"""
+        if self.recorder is None:
+            return
+        if isinstance(response, dict) and "time" in response:
+            request_time = response["time"]
+        else:
+            request_time = params.get("begin") or params.get("time") or int(time.time())
+        try:
+            self.recorder.record(operation, int(request_time), body)
+        except OSError as e:
+            logger.error(f"Could not record the response of {operation}: {e}")
+
+    def _retry_delay(self, r: Response, attempt: int) -> float:
+        for header in ("X-Rate-Limit-Retry-After-Seconds", "Retry-After"):
+            value = r.headers.get(header)
+            if value is not None and value.isdigit():
+                return float(value)
+        return self._backoff_delay(attempt)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _log_rate_limit(r: Response) -> None:
+        remaining = r.headers.get("X-Rate-Limit-Remaining")
+        if remaining is not None:
+            logger.debug(f"Opensky API requests remaining: {remaining}")
@@ -0,0 +1,134 @@
+import logging
+import select
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import closing
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import click
+
+from aviatracker import utils
+from aviatracker.database import DB, STATES_CHANNEL
+from aviatracker.metrics import start_http_server_from_env
+
+
+logger = logging.getLogger()
+
+Notification = Tuple[str, str]
+
+
+class SnapshotListener(ABC):
+    """Waits for the notifications of the ingest and the other writers of the DB.
+    The snapshots of current states are announced on STATES_CHANNEL with their request_time."""
+
+    @abstractmethod
+    def wait(self, timeout: float) -> List[Notification]:
+        """Returns (channel, payload) of the notifications received since the last call,
+        waits for them up to timeout seconds if there are none."""
+
+    @staticmethod
+    def latest_snapshot(notifications: List[Notification]) -> Optional[int]:
+        """Returns request_time of the latest snapshot announced by the notifications."""
+        times = [int(payload) for channel, payload in notifications if channel == STATES_CHANNEL and payload.isdigit()]
+        return max(times) if times else None
+
+
+class PostgresSnapshotListener(SnapshotListener):
+    """Listens on the channels with a DB connection which should be used for nothing else while it waits.
+    Notifications arrive only between transactions, the transactions of the connection should be short."""
+
+    def __init__(self, db: DB, channels: Tuple[str, ...] = (STATES_CHANNEL,)) -> None:
+        self.db = db
+        with db:
+            for channel in channels:
+                db.listen(channel)
+
+    def wait(self, timeout: float) -> List[Notification]:
+        notifications = self.db.pop_notifications()
+        if not notifications:
+            readable, _, _ = select.select([self.db.conn], [], [], timeout)
+            if readable:
+                notifications = self.db.pop_notifications()
+        return notifications
+
+
+class LocalSnapshotListener(SnapshotListener):
+    """In-process stand-in for PostgresSnapshotListener, the notifications are published by publish()."""
+
+    def __init__(self) -> None:
+        self._notifications: Deque[Notification] = deque()
+        self._condition = threading.Condition()
+
+    def publish(self, channel: str, payload: str = "") -> None:
+        with self._condition:
+            self._notifications.append((channel, payload))
+            self._condition.notify_all()
+
+    def wait(self, timeout: float) -> List[Notification]:
+        with self._condition:
+            if not self._notifications:
+                self._condition.wait(timeout)
+            notifications = list(self._notifications)
+            self._notifications.clear()
+            return notifications
+
+
+class PathsUpdater:
+    """Updates the flight paths after every new snapshot of current states, but not more often than min_interval.
+    Snapshots announced while it waits are coalesced, a snapshot which has been already applied is skipped.
+    If nothing is announced for idle_interval seconds, the paths are updated anyway, so they still get finished."""
+
+    def __init__(self, listener: SnapshotListener, min_interval: float = 20.0, idle_interval: float = 60.0) -> None:
+        self.listener = listener
+        self.min_interval = min_interval
+        self.idle_interval = idle_interval
+        self.applied_time = 0
+        self.last_run = 0.0
+
+    def step(self, update: Callable[[], None]) -> bool:
+        """Waits for the next snapshot and calls update for it. Returns True if update has been called."""
+        snapshot_time = self.listener.latest_snapshot(self.listener.wait(self.idle_interval))
+        if snapshot_time is not None and snapshot_time <= self.applied_time:
+            logger.debug(f"Snapshot {snapshot_time} has been already applied to the paths")
+            return False
+        if snapshot_time is None and time.monotonic() - self.last_run < self.idle_interval:
+            return False
+
+        deadline = self.last_run + self.min_interval
+        while time.monotonic() < deadline:
+            later = self.listener.latest_snapshot(self.listener.wait(deadline - time.monotonic()))
+            if later is not None:
+                snapshot_time = max(later, snapshot_time or 0)
+
+        update()
+        self.last_run = time.monotonic()
+        if snapshot_time is not None:
+            self.applied_time = snapshot_time
+        return True
+
+
+@click.command(name="paths-updater")
+@click.option("--min-interval", default=20.0, help="minimal interval between the updates in seconds", type=float)
+def paths_updater(min_interval: float) -> None:
+    """Update the flight paths whenever the ingest publishes a snapshot of current states"""
+    # the listeners do not need the config, so they can be used without it
+    from aviatracker.config import common_conf
+    from aviatracker.core import update_flight_paths
+
+    utils.setup_logging()
+    start_http_server_from_env()
+    params: Dict[str, Any] = common_conf.db_params
+    with closing(DB(**params)) as db:
+        updater = PathsUpdater(PostgresSnapshotListener(db), min_interval)
+        while True:
+            try:
+                updater.step(update_flight_paths)
+            except Exception as e:
+                logger.exception(f"Exception: {e}")
+                time.sleep(min_interval)
+
+
+if __name__ == "__main__":
+    paths_updater()
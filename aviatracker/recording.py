@@ -0,0 +1,131 @@
+import bisect
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, BinaryIO, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger()
+
+RECORDING_VARIABLE = "AVIATRACKER_RECORDING"
+
+# a record is the header, the operation and the zlib-compressed response body;
+# an entry of the index is the request_time and the offset of the record in the log
+HEADER = struct.Struct(">qHI")
+INDEX_ENTRY = struct.Struct(">qQ")
+
+
+class ResponseRecorder:
+    """Appends the raw responses of OpenSky to a log, indexed by request_time in a sidecar file {path}.idx.
+    Records are only appended, so a log can be replayed while it is still being recorded.
+    Every Celery worker records to the same log, a record and its index entry are written under a lock of the log
+    file, so that the offset of the entry is that of its own record. The files are opened by every process on its
+    first record, as the lock would be shared by the processes forked by Celery after the recorder was created."""
+
+    def __init__(self, path: str, level: int = 6) -> None:
+        self.path = path
+        self.level = level
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._log: Optional[BinaryIO] = None
+        self._index: Optional[BinaryIO] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseRecorder"]:
+        """Returns a recorder to the path from AVIATRACKER_RECORDING, if it is set"""
+        path = os.environ.get(RECORDING_VARIABLE)
+        if not path:
+            return None
+        logger.info(f"OpenSky responses are recorded to {path}")
+        return cls(path)
+
+    def record(self, operation: str, request_time: int, body: bytes) -> None:
+        compressed = zlib.compress(body, self.level)
+        name = operation.encode()
+        with self._lock:
+            log, index = self._files()
+            fcntl.flock(log, fcntl.LOCK_EX)
+            try:
+                offset = log.seek(0, os.SEEK_END)
+                log.write(HEADER.pack(request_time, len(name), len(compressed)) + name + compressed)
+                log.flush()
+                index.write(INDEX_ENTRY.pack(request_time, offset))
+                index.flush()
+            finally:
+                fcntl.flock(log, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid() and self._log and self._index:
+                self._log.close()
+                self._index.close()
+            self._pid = self._log = self._index = None
+
+    def _files(self) -> Tuple[BinaryIO, BinaryIO]:
+        if self._pid != os.getpid() or self._log is None or self._index is None:
+            self._log = open(self.path, "ab")
+            self._index = open(self.path + ".idx", "ab")
+            self._pid = os.getpid()
+        return self._log, self._index
+
+
+class ResponseLog:
+    """Reads a log written by ResponseRecorder"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path + ".idx", "rb") as f:
+            data = f.read()
+        # an entry cut short by a crash of the recorder is skipped
+        entries = sorted(INDEX_ENTRY.iter_unpack(data[: len(data) - len(data) % INDEX_ENTRY.size]))
+        self.times = [request_time for request_time, _ in entries]
+        self.offsets = [offset for _, offset in entries]
+
+    def read(self, offset: int) -> Tuple[int, str, Any]:
+        """Returns request_time, operation and the decoded response of the record at the offset"""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            request_time, name_size, size = HEADER.unpack(f.read(HEADER.size))
+            operation = f.read(name_size).decode()
+            return request_time, operation, json.loads(zlib.decompress(f.read(size)))
+
+    def responses(
+        self, operation: str, begin: Optional[int] = None, end: Optional[int] = None
+    ) -> Iterator[Tuple[int, Any]]:
+        """Yields (request_time, response) of the operation recorded for request_time in [begin, end)"""
+        first = 0 if begin is None else bisect.bisect_left(self.times, begin)
+        last = len(self.times) if end is None else bisect.bisect_left(self.times, end)
+        with open(self.path, "rb") as f:
+            for offset in self.offsets[first:last]:
+                f.seek(offset)
+                request_time, name_size, size = HEADER.unpack(f.read(HEADER.size))
+                if f.read(name_size).decode() != operation:
+                    continue
+                yield request_time, json.loads(zlib.decompress(f.read(size)))
+
+
+class ReplaySource:
+    """Yields the recorded /states/all responses paced by their request_time.
+    With speed 10 ten seconds of the recording pass in a second, speed 0 replays them as fast as possible."""
+
+    def __init__(self, log: ResponseLog, speed: float = 1.0) -> None:
+        self.log = log
+        self.speed = speed
+
+    def states(self, begin: Optional[int] = None, end: Optional[int] = None) -> Iterator[Tuple[int, List[List]]]:
+        started: Optional[Tuple[float, int]] = None
+        for request_time, response in self.log.responses("/states/all", begin, end):
+            if self.speed > 0:
+                if started is None:
+                    started = (time.monotonic(), request_time)
+                due = started[0] + (request_time - started[1]) / self.speed
+                pause = due - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+            if response.get("states"):
+                yield request_time, response["states"]
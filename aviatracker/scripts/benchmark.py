@@ -0,0 +1,441 @@
+import json
+import logging
+import random
+import string
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, TextIO
+
+import click
+
+from aviatracker.config import common_conf
+from aviatracker.core import update_airport_stats, update_flight_paths
+from aviatracker.database import (
+    DAY_PARTITIONED_TABLES,
+    DB,
+    OpenskyFlight,
+    StateVector,
+    patch_psycopg,
+    pooled_db,
+    unpatch_psycopg,
+)
+from aviatracker.database.database import DB_QUERIES
+from aviatracker.opensky import Opensky, decode_states
+from aviatracker.recording import ReplaySource, ResponseLog
+from aviatracker.scripts.traffic import StubOpensky, SyntheticTraffic
+from aviatracker.web.delta import DeltaStream
+from aviatracker.web.snapshot import StateSnapshot
+from aviatracker.web.producer import read_snapshot
+from aviatracker.web.ticks import Tick
+from aviatracker.web.wire import JSON_FORMAT, WireFormat
+
+
+logger = logging.getLogger()
+
+
+def make_states(quantity: int, request_time: int) -> List[StateVector]:
+    """Generates a snapshot of random aircraft states resembling a /states/all response"""
+    states = []
+    for i in range(quantity):
+        callsign = "".join(random.choices(string.ascii_uppercase, k=3)) + str(random.randint(1, 9999))
+        states.append(
+            StateVector(
+                request_time=request_time,
+                icao24=f"{i:06x}",
+                callsign=callsign.ljust(8),
+                origin_country="Benchmark",
+                time_position=request_time - random.randint(0, 10),
+                last_contact=request_time - random.randint(0, 10),
+                longitude=random.uniform(-180, 180),
+                latitude=random.uniform(-90, 90),
+                baro_altitude=random.uniform(0, 12000),
+                on_ground=False,
+                velocity=random.uniform(0, 300),
+                true_track=random.uniform(0, 360),
+                vertical_rate=random.uniform(-10, 10),
+                sensors=None,
+                geo_altitude=random.uniform(0, 12000),
+                squawk=str(random.randint(1000, 7777)),
+                spi=False,
+                position_source=0,
+            )
+        )
+    return states
+
+
+def make_flights(quantity: int, callsigns: int, begin: int) -> List[OpenskyFlight]:
+    """Generates flights resembling a /flights/all response, callsigns repeat if there are less of them than flights"""
+    airports = ["".join(random.choices(string.ascii_uppercase, k=4)) for _ in range(500)]
+    flights = []
+    for _ in range(quantity):
+        first_seen = begin + random.randint(0, 3600)
+        flights.append(
+            OpenskyFlight(
+                icao24=f"{random.randint(0, 0xFFFFFF):06x}",
+                firstSeen=first_seen,
+                estDepartureAirport=random.choice(airports),
+                lastSeen=first_seen + random.randint(1800, 36000),
+                estArrivalAirport=random.choice(airports),
+                callsign=f"BNC{random.randint(0, callsigns - 1)}".ljust(8),
+                estDepartureAirportHorizDistance=0,
+                estDepartureAirportVertDistance=0,
+                estArrivalAirportHorizDistance=0,
+                estArrivalAirportVertDistance=0,
+                departureAirportCandidatesCount=1,
+                arrivalAirportCandidatesCount=1,
+            )
+        )
+    return flights
+
+
+def measure(db: DB, run: Callable[[], None], repeat: int) -> float:
+    """Returns the best time of the run. Every run is rolled back, so the benchmark leaves no traces in the DB."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+        db.conn.rollback()
+    return min(timings)
+
+
+class Stages:
+    """Latency and the quantity of DB queries of every run of the pipeline stages"""
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, List[float]] = {}
+        self.queries: Dict[str, List[float]] = {}
+
+    def run(self, stage: str, call: Callable[[], Any]) -> Any:
+        queries = sum(DB_QUERIES.values().values())
+        start = time.perf_counter()
+        result = call()
+        self.timings.setdefault(stage, []).append(time.perf_counter() - start)
+        self.queries.setdefault(stage, []).append(sum(DB_QUERIES.values().values()) - queries)
+        return result
+
+    def report(self) -> Dict[str, Dict]:
+        report = {}
+        for stage, timings in self.timings.items():
+            ordered = sorted(timings)
+            report[stage] = {
+                "runs": len(timings),
+                "mean_sec": sum(timings) / len(timings),
+                "p50_sec": ordered[len(ordered) // 2],
+                "p95_sec": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+                "max_sec": ordered[-1],
+                "queries_per_run": sum(self.queries[stage]) / len(timings),
+            }
+        return report
+
+
+def build_tick(db: DB, stream: DeltaStream) -> Optional[bytes]:
+    """Does what the snapshot producer does with every new snapshot of current states"""
+    snapshot = read_snapshot(db)
+    if snapshot is None:
+        return None
+    return Tick.build(snapshot, stream).encode()
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@click.command(name="insert-states")
+@click.option("--rows", default=10000, help="quantity of aircraft states in a snapshot", type=int)
+@click.option("--repeat", default=5, help="quantity of runs for every ingest path", type=int)
+def insert_states(rows: int, repeat: int) -> None:
+    """Compares the per-row and the COPY-based ingest of current states"""
+    states = make_states(rows, int(time.time()))
+
+    with closing(DB(**common_conf.db_params)) as db:
+        per_row = measure(db, lambda: db.insert_current_states(states), repeat)
+        bulk = measure(db, lambda: db.copy_current_states(states), repeat)
+
+    click.echo(f"insert_current_states: {per_row:.3f} sec, {rows / per_row:.0f} rows/sec")
+    click.echo(f"copy_current_states: {bulk:.3f} sec, {rows / bulk:.0f} rows/sec")
+
+
+@click.command(name="upsert-callsigns")
+@click.option("--flights", default=20000, help="quantity of flights", type=int)
+@click.option("--callsigns", default=15000, help="quantity of distinct callsigns among the flights", type=int)
+@click.option("--chunk-size", default=1000, help="quantity of rows per INSERT of the batched path", type=int)
+@click.option("--repeat", default=3, help="quantity of runs for every upsert path", type=int)
+def upsert_callsigns(flights: int, callsigns: int, chunk_size: int, repeat: int) -> None:
+    """Compares the per-flight and the batched upsert of callsigns"""
+    records = make_flights(flights, callsigns, int(time.time()) - 259200)
+
+    def upsert_one_by_one() -> None:
+        for flight in records:
+            if flight.callsign is not None:
+                db.upsert_one_callsign(
+                    flight.callsign.strip().upper(), flight.estArrivalAirport, flight.estDepartureAirport
+                )
+
+    with closing(DB(**common_conf.db_params)) as db:
+        per_row = measure(db, upsert_one_by_one, repeat)
+        batched = measure(db, lambda: db.upsert_callsigns(records, chunk_size), repeat)
+
+    click.echo(f"upsert_one_callsign: {per_row:.3f} sec, {flights / per_row:.0f} flights/sec")
+    click.echo(f"upsert_callsigns: {batched:.3f} sec, {flights / batched:.0f} flights/sec")
+
+
+@click.command(name="decode-states")
+@click.option("--rows", default=10000, help="quantity of aircraft states in a response", type=int)
+@click.option("--repeat", default=20, help="quantity of runs for every decoder", type=int)
+def decode_states_benchmark(rows: int, repeat: int) -> None:
+    """Compares the decoding of a /states/all response into StateVector with and without decode_states"""
+    request_time = int(time.time())
+    raw_states = [list(state[1:]) for state in make_states(rows, request_time)]
+    for state in raw_states[::20]:
+        state[5] = state[6] = None
+
+    def best(run: Callable[[], object]) -> float:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    plain = best(lambda: [StateVector(*([request_time] + state)) for state in raw_states])
+    decoded = best(lambda: decode_states(request_time, raw_states))
+
+    per_10k = 10000 / rows * 1000
+    click.echo(f"StateVector per state: {plain * per_10k:.2f} ms per 10k states")
+    click.echo(f"decode_states: {decoded * per_10k:.2f} ms per 10k states, columns and filtering included")
+
+
+@click.command(name="pipeline")
+@click.option("--aircraft", default=10000, help="quantity of aircraft in the air", type=click.IntRange(1000, 50000))
+@click.option("--minutes", default=10, help="simulated minutes, a snapshot is ingested every 5 seconds", type=int)
+@click.option("--churn", default=0.002, help="share of aircraft replaced by new flights every 5 seconds", type=float)
+@click.option("--seed", default=0, help="seed of the synthetic traffic", type=int)
+@click.option("--output", default="-", help="file for the JSON report, stdout by default", type=click.File("w"))
+def pipeline(aircraft: int, minutes: int, churn: float, seed: int, output: TextIO) -> None:
+    """Runs ingest, paths, callsigns, stats and the web ticks against synthetic traffic served by a local stub
+    of OpenSky, as often as they run in production, and reports the latency and DB queries of every stage
+    and the bloat of the tables as JSON. It writes to the DB, so it should be run against a scratch database."""
+    params = common_conf.db_params
+    start_time = int(time.time())
+    traffic = SyntheticTraffic(aircraft, start_time, churn, seed=seed)
+    stages = Stages()
+    stream = DeltaStream()
+
+    with StubOpensky(traffic) as stub, pooled_db(params) as db:
+        api = Opensky("", "", stub.url, retries=0)
+        first_day = datetime.utcfromtimestamp(start_time).date()
+        with db:
+            for table in DAY_PARTITIONED_TABLES:
+                if db.is_partitioned(table):
+                    db.create_day_partitions(table, first_day - timedelta(days=1), minutes // (24 * 60) + 3)
+            tables_before = db.get_table_stats()
+        callsigns_since = start_time - 1
+
+        for tick in range(minutes * 12):
+            if tick % 120 == 0:
+                flights = stages.run("fetch_flights", lambda: api.get_flights_for_period(callsigns_since, 3600))
+                if flights:
+                    with db:
+                        stages.run("callsigns", lambda: db.upsert_callsigns(flights))
+                callsigns_since = traffic.time
+
+            stub.advance(5)
+            states = stages.run("fetch_states", lambda: api.get_current_states(traffic.time))
+            if states:
+                with db:
+                    stages.run("ingest", lambda: db.copy_current_states(states))
+            # the paths and the stats run on their schedule in the simulated time, which runs ahead of the clock
+            if tick % 4 == 3:
+                stages.run("paths", lambda: update_flight_paths(traffic.time))
+            if tick % 720 == 719:
+                stages.run("stats", lambda: update_airport_stats(traffic.time))
+            stages.run("web_tick", lambda: build_tick(db, stream))
+
+        stages.run("stats", lambda: update_airport_stats(traffic.time))
+        with db:
+            tables_after = db.get_table_stats()
+
+    report = {
+        "aircraft": aircraft,
+        "simulated_minutes": minutes,
+        "churn": churn,
+        "seed": seed,
+        "stages": stages.report(),
+        "tables_before": tables_before,
+        "tables_after": tables_after,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+
+
+@click.command(name="replay")
+@click.option("--log", "path", required=True, help="log of OpenSky responses recorded by the states worker", type=str)
+@click.option("--speed", default=10.0, help="speed of the replay, 1 is real time, 0 is as fast as possible", type=float)
+@click.option("--begin", default=None, help="request_time to start from", type=int)
+@click.option("--end", default=None, help="request_time to stop before", type=int)
+@click.option("--output", default="-", help="file for the JSON report, stdout by default", type=click.File("w"))
+def replay(path: str, speed: float, begin: Optional[int], end: Optional[int], output: TextIO) -> None:
+    """Replays recorded /states/all responses through the ingest, the paths and the stats.
+    The paths and the stats run on their schedule in the time of the recording, a run overruns its schedule
+    when it takes longer than the schedule divided by the speed. It writes to the DB, use a scratch database."""
+    params = common_conf.db_params
+    log = ResponseLog(path)
+    if not log.times:
+        raise click.ClickException(f"{path} has no recorded responses")
+    stages = Stages()
+    budgets = {"ingest": 5.0, "paths": 20.0, "stats": 3600.0}
+    overruns = {stage: 0 for stage in budgets}
+    last_run = {"paths": 0, "stats": 0}
+
+    with pooled_db(params) as db:
+        first_day = datetime.utcfromtimestamp(begin or log.times[0]).date()
+        days = (datetime.utcfromtimestamp(end or log.times[-1]).date() - first_day).days + 2
+        with db:
+            for table in DAY_PARTITIONED_TABLES:
+                if db.is_partitioned(table):
+                    db.create_day_partitions(table, first_day - timedelta(days=1), days + 1)
+
+        snapshots = 0
+        replayed: List[int] = []
+        for request_time, raw_states in ReplaySource(log, speed).states(begin, end):
+            replayed = [replayed[0] if replayed else request_time, request_time]
+            decoded = decode_states(request_time, raw_states)
+            if decoded.vectors:
+                with db:
+                    stages.run("ingest", lambda: db.copy_current_states(decoded.vectors))
+                snapshots += 1
+            if request_time - last_run["paths"] >= budgets["paths"]:
+                stages.run("paths", lambda: update_flight_paths(request_time))
+                last_run["paths"] = request_time
+            if request_time - last_run["stats"] >= budgets["stats"]:
+                stages.run("stats", lambda: update_airport_stats(request_time))
+                last_run["stats"] = request_time
+
+    if speed > 0:
+        for stage, budget in budgets.items():
+            overruns[stage] = sum(1 for timing in stages.timings.get(stage, []) if timing > budget / speed)
+    report = {
+        "log": path,
+        "speed": speed,
+        "snapshots": snapshots,
+        "recorded_seconds": replayed[-1] - replayed[0] if replayed else 0,
+        "stages": stages.report(),
+        "overruns": overruns if speed > 0 else None,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+
+
+@click.command(name="wire-format")
+@click.option("--aircraft", default=10000, help="quantity of aircraft in the air", type=int)
+@click.option("--ticks", default=60, help="quantity of broadcasts, one every 5 seconds", type=int)
+@click.option("--seed", default=0, help="seed of the synthetic traffic", type=int)
+def wire_format(aircraft: int, ticks: int, seed: int) -> None:
+    """Compares the size and the encoding time of the broadcasts in the JSON and the binary wire formats"""
+    traffic = SyntheticTraffic(aircraft, int(time.time()), seed=seed)
+    formats = {"json": JSON_FORMAT, "bin1": WireFormat(True), "bin1+deflate": WireFormat(True, True)}
+    sizes: Dict[str, Dict[str, List[int]]] = {kind: {name: [] for name in formats} for kind in ("keyframe", "delta")}
+    timings: Dict[str, List[float]] = {name: [] for name in formats}
+    stream = DeltaStream()
+
+    for _ in range(ticks):
+        traffic.advance(5)
+        vectors = [vector._asdict() for vector in decode_states(traffic.time, traffic.states()["states"]).vectors]
+        message = stream.advance(StateSnapshot(traffic.time, vectors))
+        keyframe = stream.keyframe()
+        for name, wire in formats.items():
+            start = time.perf_counter()
+            delta = message.encode(wire)
+            timings[name].append(time.perf_counter() - start)
+            sizes["delta"][name].append(len(delta))
+            sizes["keyframe"][name].append(len(keyframe.encode(wire)))
+
+    for kind, by_format in sizes.items():
+        for name, values in by_format.items():
+            click.echo(f"{kind} {name}: {sum(values) / len(values) / aircraft:.2f} bytes per aircraft")
+    for name, durations in timings.items():
+        click.echo(f"delta {name}: {sum(durations) / len(durations) * 1000:.2f} ms to encode a tick")
+
+
+@click.command(name="broadcast-jitter")
+@click.option("--interval", default=3.0, help="interval of the broadcasts in seconds", type=float)
+@click.option("--seconds", default=30, help="duration of every run", type=int)
+@click.option("--clients", default=20, help="clients looking up flights at the same time", type=int)
+@click.option("--query-seconds", default=0.5, help="duration of a lookup, it is emulated by pg_sleep", type=float)
+@click.option(
+    "--max-lateness",
+    default=None,
+    help="bound of the green lateness in seconds, a tenth of the interval by default",
+    type=float,
+)
+@click.option("--blocking/--no-blocking", default=True, help="whether to measure the blocking psycopg2 as well")
+def broadcast_jitter(
+    interval: float, seconds: int, clients: int, query_seconds: float, max_lateness: Optional[float], blocking: bool
+) -> None:
+    """Measures how late a broadcast loop of the web app wakes up while clients run slow lookups,
+    with the blocking psycopg2 and with the green wait callback the web app installs.
+    Fails if a broadcast with the green wait callback is later than max_lateness."""
+    import eventlet
+
+    eventlet.monkey_patch()
+    params = common_conf.db_params
+
+    def run() -> List[float]:
+        end = time.monotonic() + seconds
+        lateness: List[float] = []
+
+        def broadcast() -> None:
+            due = time.monotonic()
+            while due + interval < end:
+                due += interval
+                eventlet.sleep(max(due - time.monotonic(), 0))
+                lateness.append(time.monotonic() - due)
+
+        def lookup() -> None:
+            with closing(DB(**params)) as db:
+                while time.monotonic() < end:
+                    with db:
+                        with db.conn.cursor() as curs:
+                            curs.execute("SELECT pg_sleep(%s);", (query_seconds,))
+                    eventlet.sleep(random.uniform(0, query_seconds))
+
+        pool = eventlet.GreenPool(clients + 1)
+        broadcaster = pool.spawn(broadcast)
+        for _ in range(clients):
+            pool.spawn(lookup)
+        broadcaster.wait()
+        pool.waitall()
+        return sorted(lateness)
+
+    if seconds <= interval:
+        raise click.BadParameter("should be longer than --interval", param_hint="--seconds")
+    bound = interval / 10 if max_lateness is None else max_lateness
+    runs = [("blocking", unpatch_psycopg)] if blocking else []
+    runs.append(("green", patch_psycopg))
+    for name, patch in runs:
+        patch()
+        lateness = run()
+        click.echo(
+            f"{name}: broadcast late by {sum(lateness) / len(lateness) * 1000:.1f} ms on average, "
+            f"{lateness[len(lateness) // 2] * 1000:.1f} ms median, {lateness[-1] * 1000:.1f} ms at most"
+        )
+    unpatch_psycopg()
+    if lateness[-1] > bound:
+        raise click.ClickException(
+            f"a green broadcast was late by {lateness[-1] * 1000:.1f} ms, more than {bound * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    cli.add_command(insert_states)
+    cli.add_command(upsert_callsigns)
+    cli.add_command(decode_states_benchmark)
+    cli.add_command(pipeline)
+    cli.add_command(replay)
+    cli.add_command(wire_format)
+    cli.add_command(broadcast_jitter)
+
+    cli()
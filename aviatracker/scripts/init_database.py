@@ -2,13 +2,15 @@ import logging
 import os
 from contextlib import closing
 import time
+from datetime import datetime, timedelta
 from typing import List, Optional
 
 import click
 import yaml
 
 from aviatracker.config import common_conf
-from aviatracker.database import DB, Airport, OpenskyFlight
+from aviatracker.core import PARTITIONS_AHEAD
+from aviatracker.database import DAY_PARTITIONED_TABLES, DB, Airport, OpenskyFlight
 from aviatracker.opensky import Opensky
 
 
@@ -34,6 +36,33 @@ def make_tables() -> None:
                 for key in scripts.keys():
                     db.execute_script(scripts[key])
 
+        with db:
+            yesterday = datetime.utcnow().date() - timedelta(days=1)
+            for table in DAY_PARTITIONED_TABLES:
+                if db.is_partitioned(table):
+                    db.create_day_partitions(table, yesterday, PARTITIONS_AHEAD + 1)
+
+        with db:
+            active = db.rebuild_active_flights()
+            logger.info(f"{active} active flights indexed")
+
+
+@click.command(name="migrate-paths")
+def migrate_paths() -> None:
+    """Move the paths stored as JSONB arrays in flight_paths to flight_path_points.
+    The paths worker should be stopped while it runs."""
+    with closing(DB(**common_conf.db_params)) as db:
+        with db:
+            span = db.get_unmoved_paths_span()
+            if span is not None and db.is_partitioned("flight_path_points"):
+                # the legacy paths are older than the partitions kept by the maintenance
+                first_day = datetime.utcfromtimestamp(span[0]).date()
+                days = (datetime.utcfromtimestamp(span[1]).date() - first_day).days + 1
+                created = db.create_day_partitions("flight_path_points", first_day, days)
+                logger.info(f"{len(created)} partitions of flight_path_points created for the moved paths")
+            moved = db.move_paths_to_points()
+            logger.info(f"{moved} paths moved to flight_path_points")
+
 
 @click.command(name="fill-airports")
 @click.option("--file", required=True, help="airport data file", type=str)
@@ -50,27 +79,33 @@ def fill_airports(file: str) -> None:
 
 
 @click.command(name="fill-callsigns")
-def fill_callsigns() -> None:
+@click.option("--chunk-size", default=1000, help="quantity of callsigns written per INSERT", type=int)
+@click.option("--workers", default=4, help="quantity of hour intervals requested at once", type=int)
+@click.option("--pause", default=30, help="pause between the requests in seconds", type=int)
+def fill_callsigns(chunk_size: int, workers: int, pause: int) -> None:
     """Fill callsigns for the period [yesterday - 2 weeks, yesterday].
     There is a delay of when finished flights appear in /flights/all"""
-    api = Opensky()
+    api = Opensky(retries=5)
     with closing(DB(**common_conf.db_params)) as db:
         end = int(time.time()) - 17280  # 2 days ago
         begin = end - 604800  # 1 week before the end
 
-        while begin < end:
-            with db:
-                flights: Optional[List[OpenskyFlight]] = api.get_flights_for_period(begin)
+        begins = list(range(begin, end, 3600))
+        for i in range(0, len(begins), workers):
+            for period_begin, flights in api.get_flights_for_periods(begins[i : i + workers], workers=workers):
                 if flights:
-                    db.upsert_callsigns(flights)
-                    begin += 3600
+                    with db:
+                        db.upsert_callsigns(flights, chunk_size)
                     logger.info(f"{len(flights)} flights upserted")
-                    time.sleep(30)
+                else:
+                    logger.warning(f"No flights received for the hour starting at {period_begin}")
+            time.sleep(pause)
 
 
 if __name__ == "__main__":
     cli.add_command(fill_airports)
     cli.add_command(make_tables)
     cli.add_command(fill_callsigns)
+    cli.add_command(migrate_paths)
 
     cli()
@@ -0,0 +1,181 @@
+import json
+import math
+import random
+import string
+import threading
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from aviatracker.metrics import ThreadingHTTPServer
+
+
+EARTH_METERS_PER_DEGREE = 111320
+
+
+class SyntheticTraffic:
+    """Synthetic air traffic producing /states/all and /flights/all payloads of OpenSky.
+    Aircraft fly straight with small turns at cruise speed. On every step a churn share of them lands
+    and is replaced by new aircraft with new callsigns, and a null_position share reports no position.
+    The same seed gives the same traffic."""
+
+    def __init__(
+        self,
+        aircraft: int = 10000,
+        start_time: int = 0,
+        churn: float = 0.002,
+        null_position: float = 0.01,
+        airports: int = 500,
+        seed: int = 0,
+    ) -> None:
+        self.random = random.Random(seed)
+        self.time = start_time
+        self.churn = churn
+        self.null_position = null_position
+        self.airports = ["".join(self.random.choices(string.ascii_uppercase, k=4)) for _ in range(airports)]
+        self.next_icao = 0
+        self.flights: Dict[str, Dict] = {}
+        self.aircraft = [self._new_aircraft() for _ in range(aircraft)]
+
+    def _new_aircraft(self) -> Dict:
+        icao24 = f"{self.next_icao:06x}"
+        self.next_icao += 1
+        callsign = "".join(self.random.choices(string.ascii_uppercase, k=3)) + str(self.random.randint(1, 9999))
+        self.flights[callsign] = {
+            "icao24": icao24,
+            "firstSeen": self.time,
+            "estDepartureAirport": self.random.choice(self.airports),
+            "estArrivalAirport": self.random.choice(self.airports),
+        }
+        return {
+            "icao24": icao24,
+            "callsign": callsign.ljust(8),
+            "origin_country": self.random.choice(["Germany", "France", "United States", "Japan", "Brazil"]),
+            "longitude": self.random.uniform(-180, 180),
+            "latitude": math.degrees(math.asin(self.random.uniform(-0.95, 0.95))),
+            "baro_altitude": self.random.uniform(3000, 12000),
+            "velocity": self.random.uniform(180, 260),
+            "true_track": self.random.uniform(0, 360),
+            "vertical_rate": 0.0,
+            "last_contact": self.time,
+        }
+
+    def advance(self, seconds: int) -> None:
+        self.time += seconds
+        for index, aircraft in enumerate(self.aircraft):
+            if self.random.random() < self.churn:
+                self.aircraft[index] = self._new_aircraft()
+                continue
+            aircraft["true_track"] = (aircraft["true_track"] + self.random.gauss(0, 0.5)) % 360
+            distance = aircraft["velocity"] * seconds / EARTH_METERS_PER_DEGREE
+            track = math.radians(aircraft["true_track"])
+            latitude = aircraft["latitude"] + distance * math.cos(track)
+            if abs(latitude) > 85:
+                aircraft["true_track"] = (aircraft["true_track"] + 180) % 360
+                latitude = aircraft["latitude"]
+            longitude = aircraft["longitude"] + distance * math.sin(track) / max(math.cos(math.radians(latitude)), 0.1)
+            aircraft["latitude"], aircraft["longitude"] = latitude, (longitude + 180) % 360 - 180
+            aircraft["last_contact"] = self.time - self.random.randint(0, 4)
+
+    def states(self) -> Dict:
+        states = []
+        for aircraft in self.aircraft:
+            hidden = self.random.random() < self.null_position
+            states.append(
+                [
+                    aircraft["icao24"],
+                    aircraft["callsign"],
+                    aircraft["origin_country"],
+                    aircraft["last_contact"],
+                    aircraft["last_contact"],
+                    None if hidden else aircraft["longitude"],
+                    None if hidden else aircraft["latitude"],
+                    aircraft["baro_altitude"],
+                    False,
+                    aircraft["velocity"],
+                    aircraft["true_track"],
+                    aircraft["vertical_rate"],
+                    None,
+                    aircraft["baro_altitude"],
+                    None,
+                    False,
+                    0,
+                ]
+            )
+        return {"time": self.time, "states": states}
+
+    def flights_for_period(self, begin: int, end: int) -> List[Dict]:
+        """Returns the flights started during the period, as if they were already finished"""
+        flights = []
+        for callsign, flight in self.flights.items():
+            if begin <= flight["firstSeen"] < end:
+                flights.append(
+                    {
+                        "icao24": flight["icao24"],
+                        "firstSeen": flight["firstSeen"],
+                        "estDepartureAirport": flight["estDepartureAirport"],
+                        "lastSeen": flight["firstSeen"] + 3600,
+                        "estArrivalAirport": flight["estArrivalAirport"],
+                        "callsign": callsign.ljust(8),
+                        "estDepartureAirportHorizDistance": 0,
+                        "estDepartureAirportVertDistance": 0,
+                        "estArrivalAirportHorizDistance": 0,
+                        "estArrivalAirportVertDistance": 0,
+                        "departureAirportCandidatesCount": 1,
+                        "arrivalAirportCandidatesCount": 1,
+                    }
+                )
+        return flights
+
+
+class StubOpensky:
+    """Local HTTP server answering /states/all and /flights/all of OpenSky from the synthetic traffic.
+    The time of the traffic is moved by its owner, the requested time is ignored."""
+
+    def __init__(self, traffic: SyntheticTraffic, port: int = 0) -> None:
+        self.traffic = traffic
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                with stub.lock:
+                    if url.path.endswith("/states/all"):
+                        payload: Optional[object] = stub.traffic.states()
+                    elif url.path.endswith("/flights/all"):
+                        begin = int(query.get("begin", ["0"])[0])
+                        end = int(query.get("end", [str(begin + 3600)])[0])
+                        payload = stub.traffic.flights_for_period(begin, end)
+                    else:
+                        payload = None
+                if payload is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def advance(self, seconds: int) -> None:
+        with self.lock:
+            self.traffic.advance(seconds)
+
+    def __enter__(self) -> "StubOpensky":
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
+        self.server.shutdown()
+        self.server.server_close()
@@ -8,6 +8,7 @@ app = Celery(
     include=["aviatracker.tasks.tasks"],
 )
 
+# flight paths are updated by aviatracker.pipeline after every snapshot of current states instead of on a schedule
 app.conf.beat_schedule = {
     "every-five-sec-insert-states": {
         "task": "aviatracker.tasks.tasks.insert_states",
@@ -15,12 +16,6 @@ app.conf.beat_schedule = {
         "options": {"queue": "states"},
         "args": (),
     },
-    "every-twenty-sec-update-paths": {
-        "task": "aviatracker.tasks.tasks.update_paths",
-        "schedule": 20.0,
-        "options": {"queue": "paths"},
-        "args": (),
-    },
     "every-23-hours-update-callsigns": {
         "task": "aviatracker.tasks.tasks.update_callsigns",
         "schedule": 600,
@@ -33,4 +28,10 @@ app.conf.beat_schedule = {
         "options": {"queue": "celery"},
         "args": (),
     },
+    "every-hour-maintain-tables": {
+        "task": "aviatracker.tasks.tasks.maintain_tables",
+        "schedule": 3600.0,
+        "options": {"queue": "celery"},
+        "args": (),
+    },
 }
@@ -1,21 +1,52 @@
 import logging
 import sys
 import time
-from contextlib import closing
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from celery.app.log import TaskFormatter
-from celery.signals import after_setup_task_logger
+from celery.signals import after_setup_task_logger, task_failure, task_postrun, task_prerun, worker_process_init
 from celery.utils.log import get_task_logger
 
 from aviatracker.config import common_conf
-from aviatracker.database import DB, StateVector, OpenskyFlight
+from aviatracker.database import pooled_db, StateVector, OpenskyFlight
+from aviatracker.metrics import Counter, Histogram, start_http_server_from_env
 from aviatracker.opensky import Opensky
+from aviatracker.recording import ResponseRecorder
 from aviatracker.tasks.celery import app
-from aviatracker.core import update_flight_paths, update_airport_stats
+from aviatracker.core import maintain_partitions, update_flight_paths, update_airport_stats
 
 logger = get_task_logger(__name__)
 
+# the client keeps connections to the API alive, so it is shared by the tasks of a worker process,
+# its responses are recorded for replays if AVIATRACKER_RECORDING is set
+api = Opensky(recorder=ResponseRecorder.from_env())
+
+TASK_SECONDS = Histogram("aviatracker_task_seconds", "Duration of Celery tasks", ("task",))
+TASK_FAILURES = Counter("aviatracker_task_failures_total", "Celery tasks which have raised", ("task",))
+task_starts: Dict[str, float] = {}
+
+
+@worker_process_init.connect
+def start_metrics_server(*args, **kwargs) -> None:  # type: ignore
+    start_http_server_from_env()
+
+
+@task_prerun.connect
+def start_task_timer(task_id: str, *args, **kwargs) -> None:  # type: ignore
+    task_starts[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def stop_task_timer(task_id: str, task, *args, **kwargs) -> None:  # type: ignore
+    start = task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_SECONDS.labels(task.name).observe(time.perf_counter() - start)
+
+
+@task_failure.connect
+def count_task_failure(sender, *args, **kwargs) -> None:  # type: ignore
+    TASK_FAILURES.labels(sender.name).inc()
+
 
 @after_setup_task_logger.connect
 def setup_task_logger(logger: logging.Logger, *args, **kwargs) -> None:  # type: ignore
@@ -27,12 +58,11 @@ def setup_task_logger(logger: logging.Logger, *args, **kwargs) -> None:  # type:
 def update_callsigns(self) -> None:  # type: ignore
     logger.debug("Starting task update_callsigns")
     self.time_limit = 15
-    api = Opensky()
     flights: Optional[List[OpenskyFlight]] = api.get_flights_for_period(int(time.time()) - 259200)
 
     if flights:
         logger.debug(f"Received {len(flights)} flights")
-        with closing(DB(**common_conf.db_params)) as db:
+        with pooled_db(common_conf.db_params) as db:
             with db:
                 db.upsert_callsigns(flights)
 
@@ -43,16 +73,15 @@ def insert_states(self) -> None:  # type: ignore
     logger.debug("Starting task insert_states")
     cur_time = int(time.time())
 
-    api = Opensky()
     try:
         logger.debug(f"A request has been sent to API for the timestamp: {cur_time}")
         states: Optional[List[StateVector]] = api.get_current_states(time_sec=cur_time)
         logger.debug(f"A response has been received from API for the timestamp: {cur_time}")
         if states:
             logger.debug(f"received {len(states)} states")
-            with closing(DB(**common_conf.db_params)) as db:
+            with pooled_db(common_conf.db_params) as db:
                 with db:
-                    db.insert_current_states(states)
+                    db.copy_current_states(states)
 
     except Exception as e:
         logger.exception(f"Exception: {e}")
@@ -80,9 +109,17 @@ def update_paths(self) -> None:  # type: ignore
 def update_stats(self) -> None:  # type: ignore
     self.time_limit = 10
     try:
-        with closing(DB(**common_conf.db_params)) as db:
-            with db:
-                logger.debug("Starting airports statistics update")
-                update_airport_stats()
+        logger.debug("Starting airports statistics update")
+        update_airport_stats()
+    except Exception as e:
+        logger.exception(f"Exception: {e}")
+
+
+@app.task(bind=True)
+def maintain_tables(self) -> None:  # type: ignore
+    self.time_limit = 60
+    try:
+        logger.debug("Starting partitions maintenance")
+        maintain_partitions()
     except Exception as e:
         logger.exception(f"Exception: {e}")
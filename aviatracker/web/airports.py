@@ -0,0 +1,38 @@
+import gzip
+import hashlib
+import json
+import logging
+from typing import Dict, List
+
+from aviatracker.database import DB
+
+
+logger = logging.getLogger()
+
+
+class AirportsCatalog:
+    """Airports reference data loaded once and kept ready to be served.
+    Only the fields used by the map are kept. The payload is serialized and gzip-compressed on load
+    and identified by an ETag, so clients revalidate it for free until the airports table is changed."""
+
+    fields = ("icao", "name", "city", "country", "longitude", "latitude")
+
+    def __init__(self) -> None:
+        self.airports: List[Dict] = []
+        self.payload = b"[]"
+        self.compressed = gzip.compress(self.payload)
+        self.etag = self._etag(self.payload)
+
+    def load(self, db: DB) -> None:
+        airports = db.get_all_airports() or []
+        self.airports = [{field: airport[field] for field in self.fields} for airport in airports]
+        payload = json.dumps(self.airports, separators=(",", ":")).encode()
+        self.payload, self.compressed, self.etag = payload, gzip.compress(payload, 9), self._etag(payload)
+        logger.info(f"{len(self.airports)} airports loaded, {len(self.compressed)} bytes compressed")
+
+    @staticmethod
+    def _etag(payload: bytes) -> str:
+        return hashlib.sha1(payload).hexdigest()
+
+
+airports_catalog = AirportsCatalog()
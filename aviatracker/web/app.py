@@ -3,16 +3,26 @@ import eventlet
 eventlet.monkey_patch()
 
 from contextlib import closing
+import os
 import threading
 import time
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional
 
-from flask import Flask, render_template
+from flask import Flask, Response, render_template, request
+from eventlet.greenthread import GreenThread
 from flask_socketio import SocketIO
 
 from aviatracker import utils
-from aviatracker.database import DB
+from aviatracker.database import DB, AIRPORTS_CHANNEL, PoolTimeout, patch_psycopg, pooled_db
 from aviatracker.config import common_conf
+from aviatracker.metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from aviatracker.pipeline import PostgresSnapshotListener
+from aviatracker.web.airports import airports_catalog
+from aviatracker.web.producer import SNAPSHOT_TIMEOUT, produce_ticks
+from aviatracker.web.ticks import SOCKET_VARIABLE, LocalTickChannel, Tick, TickSubscriber
+from aviatracker.web.trajectory import SimplifiedPathCache, simplify, tolerance_for_zoom
+from aviatracker.web.viewport import TileGrid, Viewport, parse_viewport, parse_zoom
+from aviatracker.web.wire import JSON_FORMAT, Message, WireFormat, encode_flight, parse_format
 
 
 app = Flask(__name__)
@@ -26,6 +36,57 @@ socketio = SocketIO(
     cors_allowed_origins=common_conf.websocket_allowed_origin,
 )
 
+# with delta broadcasts clients receive only the changes since the previous tick and a periodic keyframe,
+# otherwise the whole snapshot is sent every tick
+DELTA_BROADCASTS = True
+
+# clients which have subscribed with their viewport receive only the aircraft of their viewport,
+# or the density of aircraft if their map is zoomed out, the others receive the global broadcast
+DENSITY_ZOOM = 4
+subscriptions: Dict[str, Viewport] = {}
+
+# wire format of every connected client, a broadcast is encoded once per format in use rather than once per client
+formats: Dict[str, WireFormat] = {}
+
+# a client chooses its wire format as soon as it connects, so it gets its first keyframe and the ticks only then,
+# in JSON if it has not chosen within FORMAT_TIMEOUT seconds; the timers of the clients still to choose are kept here
+FORMAT_TIMEOUT = 2.0
+awaiting_format: Dict[str, GreenThread] = {}
+
+# a tick is sent to a client only while at most MAX_QUEUED_PACKETS packets wait to be written to its connection,
+# otherwise the tick is held back in place of the one held before, so that a slow client costs at most one tick
+# of memory; once the connection drains the client gets the state in full. The replies are never held back.
+MAX_QUEUED_PACKETS = 64
+DRAIN_INTERVAL = 0.5
+held_ticks: Dict[str, Tick] = {}
+
+
+# the queries of the clients yield to the hub while they wait for the DB, see start_webapp;
+# a lookup waits for a pooled connection up to LOOKUP_TIMEOUT seconds and is dropped after that,
+# so a burst of clicks can not pile up behind slow queries
+LOOKUP_TIMEOUT = 2.0
+
+# paths are simplified to about a pixel at the zoom of the client, then only the new points are sent to it
+DEFAULT_PATH_ZOOM = 6
+simplified_paths = SimplifiedPathCache()
+
+CLIENTS = Gauge("aviatracker_clients", "Connected clients")
+SUBSCRIBED_CLIENTS = Gauge("aviatracker_subscribed_clients", "Clients receiving only the aircraft of their viewport")
+BROADCAST_SECONDS = Histogram("aviatracker_broadcast_seconds", "Duration of the broadcasts of a snapshot to clients")
+SNAPSHOT_AGE = Histogram(
+    "aviatracker_snapshot_age_seconds",
+    "Time between request_time of a snapshot and its broadcast",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 60, 120),
+)
+DROPPED_TICKS = Counter("aviatracker_dropped_ticks_total", "Ticks held back from slow clients and replaced by later")
+HELD_TICKS = Gauge("aviatracker_held_ticks", "Clients with a tick held back until their connection drains")
+SEND_QUEUE_PACKETS = Histogram(
+    "aviatracker_send_queue_packets",
+    "Packets waiting to be written to the connection of a client when a tick is due",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+LOOKUPS_REJECTED = Counter("aviatracker_lookups_rejected_total", "Lookups of clients dropped for want of a connection")
+
 
 @app.route("/")
 def index() -> str:
@@ -37,80 +98,203 @@ def about() -> str:
     return render_template("about.html")
 
 
+@app.route("/airports.json", methods=["GET"])
+def airports() -> Response:
+    """Serves the airports catalog, the clients revalidate it with its ETag"""
+    if request.if_none_match.contains(airports_catalog.etag):
+        response = Response(status=304)
+    elif "gzip" in request.accept_encodings:
+        response = Response(airports_catalog.compressed, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(airports_catalog.payload, mimetype="application/json")
+    response.set_etag(airports_catalog.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Response:
+    return Response(REGISTRY.exposition(), content_type=CONTENT_TYPE)
+
+
 @socketio.on("connect")
 def connect() -> None:
     logger.debug("A client has been connected to the server")
+    CLIENTS.inc()
+    sid: str = request.sid  # type: ignore
+    awaiting_format[sid] = eventlet.spawn_after(FORMAT_TIMEOUT, choose_format, sid, JSON_FORMAT)
 
 
 @socketio.on("message")
 def send_airports(message: List) -> None:
     logger.info(f"server received message: {message}")
     if message[0] == "icao24":
+        if len(message) < 4:
+            return
         icao = message[1]
         x = message[2]
         y = message[3]
-        current_flight: Optional[Dict] = fetch_current_flight(icao, common_conf.db_params)
+        zoom = parse_zoom(message[4]) if len(message) > 4 else DEFAULT_PATH_ZOOM
+        if zoom is None:
+            return
+        try:
+            current_flight: Optional[Dict] = fetch_current_flight(icao, zoom, common_conf.db_params)
+        except PoolTimeout as e:
+            reject_lookup(message[0], e)
+            return
         if current_flight:
-            current_flight_message = [["flight"], current_flight, [x], [y]]
-            logger.info(f"server sends paths_message: {current_flight_message}")
-            socketio.send(current_flight_message)
+            logger.info(f"server sends a path of {len(current_flight['path'])} points for {icao}")
+            wire = formats.get(request.sid, JSON_FORMAT)  # type: ignore
+            current_flight_message = [["flight"], encode_flight(current_flight, wire), [x], [y]]
+            socketio.send(current_flight_message, room=request.sid)  # type: ignore
     elif message[0] == "path-update":
-        flight: Optional[Dict] = fetch_current_flight(message[1], common_conf.db_params)
+        path_id, last_point_id = (message[2], message[3]) if len(message) > 3 else (None, 0)
+        try:
+            flight: Optional[Dict] = fetch_path_update(message[1], path_id, last_point_id, common_conf.db_params)
+        except PoolTimeout as e:
+            reject_lookup(message[0], e)
+            return
         if flight:
-            socketio.send(["path-update", flight])
+            wire = formats.get(request.sid, JSON_FORMAT)  # type: ignore
+            socketio.send(["path-update", encode_flight(flight, wire)], room=request.sid)  # type: ignore
+    elif message[0] == "keyframe":
+        send_keyframe(request.sid)  # type: ignore
+    elif message[0] == "format":
+        choose_format(request.sid, parse_format(message[1], message[2] if len(message) > 2 else False))  # type: ignore
+    elif message[0] == "subscribe":
+        viewport = parse_viewport(message[1:])
+        if viewport is None:
+            return
+        subscriptions[request.sid] = viewport  # type: ignore
+        SUBSCRIBED_CLIENTS.set(len(subscriptions))
+        if current_tick is not None:
+            send_viewport(request.sid, viewport, current_tick.tiles)  # type: ignore
+    elif message[0] == "unsubscribe":
+        if subscriptions.pop(request.sid, None) is not None:  # type: ignore
+            SUBSCRIBED_CLIENTS.set(len(subscriptions))
+            send_keyframe(request.sid)  # type: ignore
     else:
-        airports: Optional[List[Dict]] = fetch_airports(common_conf.db_params)
-        if airports is not None:
-            airports_message = ["airports", airports]
-            socketio.send(airports_message)
+        airports_message = ["airports", airports_catalog.airports]
+        socketio.send(airports_message, room=request.sid)  # type: ignore
+
+
+def reject_lookup(kind: str, error: PoolTimeout) -> None:
+    LOOKUPS_REJECTED.inc()
+    logger.warning(f"A {kind} lookup has been dropped: {error}")
 
 
 @socketio.on("disconnect")
 def disconnect() -> None:
     logger.debug("A client has been disconnected from the server")
+    CLIENTS.dec()
+    subscriptions.pop(request.sid, None)  # type: ignore
+    formats.pop(request.sid, None)  # type: ignore
+    timer = awaiting_format.pop(request.sid, None)  # type: ignore
+    if timer is not None:
+        timer.cancel()
+    held_ticks.pop(request.sid, None)  # type: ignore
+    SUBSCRIBED_CLIENTS.set(len(subscriptions))
 
 
-states_memo = None
+# the ticks are built by the snapshot producer, either a thread of this process or a process of its own
+# serving all web workers, see start_webapp
+current_tick: Optional[Tick] = None
 
 
-def fetch_airports(params: Dict[str, Any]) -> Optional[List[Dict]]:
-    with closing(DB(**params)) as db:
-        with db:
-            airports: Optional[List[Dict]] = db.get_all_airports()
-    return airports
+def choose_format(sid: str, wire: WireFormat) -> None:
+    """Sets the wire format of the client, it gets the current state of all aircraft in it
+    and the ticks from then on"""
+    timer = awaiting_format.pop(sid, None)
+    if timer is not None:
+        timer.cancel()
+    formats[sid] = wire
+    send_keyframe(sid)
+
+
+def send_keyframe(sid: str) -> None:
+    """Sends the current state of all aircraft to the client"""
+    if current_tick is not None:
+        socketio.send(current_tick.keyframe.encode(formats.get(sid, JSON_FORMAT)), room=sid)
+
+
+def send_viewport(sid: str, viewport: Viewport, tiles: TileGrid) -> None:
+    wire = formats.get(sid, JSON_FORMAT)
+    if viewport.zoom < DENSITY_ZOOM:
+        socketio.send(tiles.density().encode(wire), room=sid)
+    else:
+        socketio.send(["tiles"] + [tiles.payload(cell).encode(wire) for cell in tiles.cells_in(viewport)], room=sid)
+
+
+def queued_packets(sid: str) -> int:
+    """Returns the quantity of packets waiting to be written to the connection of the client,
+    engine.io queues them without a limit. The queue is not exposed by engine.io, it is read the way
+    the versions of python-engineio in requirements.txt keep it."""
+    server = socketio.server
+    # python-socketio 5 gives the client a sid of its own in every namespace, 4 uses the sid of engine.io
+    eio_sid_from_sid = getattr(server.manager, "eio_sid_from_sid", None)
+    eio_sid = eio_sid_from_sid(sid, "/") if eio_sid_from_sid is not None else sid
+    queue = getattr(server.eio.sockets.get(eio_sid), "queue", None)
+    return queue.qsize() if queue is not None else 0
+
+
+def send_tick(sid: str, tick: Tick, message: Message) -> None:
+    """Sends the tick to the client, or holds it back if the connection of the client is congested"""
+    queued = queued_packets(sid)
+    SEND_QUEUE_PACKETS.observe(queued)
+    if queued > MAX_QUEUED_PACKETS:
+        if sid in held_ticks:
+            DROPPED_TICKS.inc()
+        held_ticks[sid] = tick
+        return
+    if held_ticks.pop(sid, None) is not None:
+        # the client has missed a delta, so it gets the whole state instead
+        message = tick.keyframe
+    viewport = subscriptions.get(sid)
+    if viewport is not None:
+        send_viewport(sid, viewport, tick.tiles)
+    else:
+        socketio.send(message.encode(formats.get(sid, JSON_FORMAT)), room=sid)
 
 
-def fetch_aircraft_states(params: Dict[str, Any]) -> None:
+def drain_held_ticks() -> None:
+    """Sends the held back ticks to the clients whose connections have drained since"""
+    while True:
+        eventlet.sleep(DRAIN_INTERVAL)
+        for sid, tick in list(held_ticks.items()):
+            if held_ticks.get(sid) is tick and queued_packets(sid) <= MAX_QUEUED_PACKETS:
+                del held_ticks[sid]
+                send_tick(sid, tick, tick.keyframe)
+        HELD_TICKS.set(len(held_ticks))
+
+
+def watch_airports(params: Dict[str, Any]) -> None:
+    """Reloads the airports catalog whenever it is announced to be changed"""
     with closing(DB(**params)) as db:
+        listener = PostgresSnapshotListener(db, (AIRPORTS_CHANNEL,))
         while True:
-            with db:
-                vectors: Optional[List[Dict]] = db.get_current_states()
-            if vectors is not None:
-                for vector in vectors:
-                    airports: Optional[Tuple[str, str]] = db.get_airports_for_callsign(vector["callsign"])
-                    # logger.info(f"airports for callsign {vector['callsign']}: {airports}")
-                    if airports:
-                        est_arrival_airport = airports[0]
-                        est_departure_airport = airports[1]
-                        vector["est_arrival_airport"] = est_arrival_airport
-                        vector["est_departure_airport"] = est_departure_airport
-
-                quantity = len(vectors)
-                global states_memo
-                states_memo = vectors
-                logger.info(f"{quantity} states fetched from the DB for the time {vectors[0]['request_time']}")
-                time.sleep(4)
-
-
-def broadcast_states() -> None:
-    while True:
-        socketio.send(states_memo)
-        eventlet.sleep(3)
-        time.sleep(1)
+            if listener.wait(SNAPSHOT_TIMEOUT):
+                with db:
+                    airports_catalog.load(db)
+
+
+def broadcast_states(ticks: Iterator[Tick]) -> None:
+    global current_tick
+    version: Optional[int] = None
+    for tick in ticks:
+        SNAPSHOT_AGE.observe(time.time() - tick.request_time)
+        start = time.perf_counter()
+        message = tick.broadcast_after(version)
+        current_tick, version = tick, tick.version
+        for sid in list(formats):
+            send_tick(sid, tick, message)
+        HELD_TICKS.set(len(held_ticks))
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
 
 
 def fetch_paths(icao: str, params: Dict[str, Any]) -> Optional[List[Dict]]:
-    with closing(DB(**params)) as db:
+    with pooled_db(params) as db:
         with db:
             flights: Optional[List[Dict]] = db.get_all_paths_for_icao(icao)
             if flights:
@@ -119,14 +303,48 @@ def fetch_paths(icao: str, params: Dict[str, Any]) -> Optional[List[Dict]]:
                 return None
 
 
-def fetch_current_flight(icao: str, params: Dict[str, Any]) -> Optional[Dict]:
-    with closing(DB(**params)) as db:
+def fetch_current_flight(icao: str, zoom: float, params: Dict[str, Any]) -> Optional[Dict]:
+    """Returns the unfinished path of the aircraft simplified for the zoom level"""
+    with pooled_db(params, LOOKUP_TIMEOUT) as db:
         with db:
-            flight: Optional[Dict] = db.find_unfinished_path_for_aircraft(icao)
-            if flight:
-                return flight
-            else:
-                return None
+            found = db.get_unfinished_path_points(icao)
+    if found is None:
+        return None
+
+    flight, points = found
+    last_point_id = points[-1][0] if points else 0
+    key = (flight["path_id"], last_point_id, int(zoom))
+    path = simplified_paths.get(key)
+    if path is None:
+        path = simplify(
+            [(lon, lat) for _, lon, lat in points if lon is not None and lat is not None], tolerance_for_zoom(zoom)
+        )
+        simplified_paths.put(key, path)
+
+    flight["path"] = [{"longitude": longitude, "latitude": latitude} for longitude, latitude in path]
+    flight["last_point_id"] = last_point_id
+    return flight
+
+
+def fetch_path_update(icao: str, path_id: Optional[int], last_point_id: int, params: Dict[str, Any]) -> Optional[Dict]:
+    """Returns the points appended to the path after last_point_id.
+    If the aircraft has started another path, the whole new path is returned with the full flag set."""
+    with pooled_db(params, LOOKUP_TIMEOUT) as db:
+        with db:
+            found = db.get_unfinished_path_points(icao, last_point_id or 0)
+            if found is not None and found[0]["path_id"] != path_id:
+                found = db.get_unfinished_path_points(icao)
+    if found is None:
+        return None
+
+    flight, points = found
+    flight["full"] = flight["path_id"] != path_id
+    flight["path"] = [{"longitude": longitude, "latitude": latitude} for _, longitude, latitude in points]
+    if points:
+        flight["last_point_id"] = points[-1][0]
+    else:
+        flight["last_point_id"] = 0 if flight["full"] else last_point_id
+    return flight
 
 
 def start_app() -> None:
@@ -135,21 +353,35 @@ def start_app() -> None:
 
 
 def start_webapp() -> None:
-    fetching_thread = threading.Thread(
-        target=fetch_aircraft_states,
-        daemon=True,
-        args=(common_conf.db_params,),
-    )
-    fetching_thread.start()
-
-    broadcasting_greenthread = eventlet.spawn(broadcast_states)
+    patch_psycopg()
+    with pooled_db(common_conf.db_params) as db:
+        with db:
+            airports_catalog.load(db)
+
+    airports_thread = threading.Thread(target=watch_airports, daemon=True, args=(common_conf.db_params,))
+    airports_thread.start()
+
+    ticks_socket = os.environ.get(SOCKET_VARIABLE)
+    if ticks_socket:
+        # the snapshots are read by the snapshot producer, this worker only fans its ticks out to the clients
+        ticks: Iterator[Tick] = TickSubscriber(ticks_socket).ticks()
+    else:
+        channel = LocalTickChannel()
+        ticks = channel.ticks()
+        producing_thread = threading.Thread(
+            target=produce_ticks,
+            daemon=True,
+            args=(common_conf.db_params, channel.publish, DELTA_BROADCASTS),
+        )
+        producing_thread.start()
+
+    broadcasting_greenthread = eventlet.spawn(broadcast_states, ticks)
+    eventlet.spawn(drain_held_ticks)
     app_launch_greenthread = eventlet.spawn(start_app)
 
     app_launch_greenthread.wait()
     broadcasting_greenthread.wait()
 
-    fetching_thread.join()
-
 
 if __name__ == "__main__":
     start_webapp()
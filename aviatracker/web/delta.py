@@ -0,0 +1,85 @@
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+from aviatracker.web.snapshot import StateSnapshot
+from aviatracker.web.wire import Message
+
+
+class DeltaStream:
+    """Turns successive snapshots into versioned delta messages.
+    A delta carries the added aircraft in full, icao24 of the removed ones and only the changed fields of the rest.
+    Floats are quantized beforehand, so that a negligible movement of an aircraft is not reported as a change.
+    Every keyframe_interval-th message is a keyframe with all aircraft, a keyframe of the current version
+    is also available on demand for the clients which join late or miss a delta."""
+
+    # decimal places kept for every float column, 4 places of a degree are about 11 meters
+    precision = {"longitude": 4, "latitude": 4, "baro_altitude": 0, "velocity": 1, "true_track": 0}
+
+    def __init__(self, keyframe_interval: int = 20) -> None:
+        self.keyframe_interval = keyframe_interval
+        self.version = 0
+        self.fields: List[str] = list(StateSnapshot.row_fields)
+        self._aircraft: Dict[str, Tuple] = {}
+        self._keyframe: Optional[Message] = None
+
+    def advance(self, snapshot: StateSnapshot) -> Message:
+        """Makes the snapshot the current version and returns the message for the clients of the previous one"""
+        aircraft = self._quantize(snapshot)
+        base = self.version
+        self.version += 1
+
+        if self.version % self.keyframe_interval == 0:
+            self._aircraft = aircraft
+            self._keyframe = None
+            return self.keyframe()
+
+        added: List[Tuple] = []
+        changed: List[List] = []
+        for icao24, values in aircraft.items():
+            previous = self._aircraft.get(icao24)
+            if previous is None:
+                added.append(values)
+            elif previous != values:
+                fields = {self.fields[i]: value for i, (value, old) in enumerate(zip(values, previous)) if value != old}
+                changed.append([icao24, fields])
+        removed = [icao24 for icao24 in self._aircraft if icao24 not in aircraft]
+
+        self._aircraft = aircraft
+        self._keyframe = None
+        return Message(
+            {
+                "type": "delta",
+                "version": self.version,
+                "base": base,
+                "fields": self.fields,
+                "added": added,
+                "removed": removed,
+                "changed": changed,
+            }
+        )
+
+    def keyframe(self) -> Message:
+        if self._keyframe is None:
+            self._keyframe = Message(
+                {
+                    "type": "keyframe",
+                    "version": self.version,
+                    "fields": self.fields,
+                    "aircraft": list(self._aircraft.values()),
+                }
+            )
+        return self._keyframe
+
+    def _quantize(self, snapshot: StateSnapshot) -> Dict[str, Tuple]:
+        aircraft: Dict[str, Tuple] = {}
+        for index in range(snapshot.size):
+            row = snapshot.row(index)
+            values: List[Any] = []
+            for name in self.fields:
+                value = row[name]
+                if name in self.precision and value is not None:
+                    value = round(value, self.precision[name]) if math.isfinite(value) else None
+                values.append(value)
+            if values[0] is not None:
+                aircraft[values[0]] = tuple(values)
+        return aircraft
@@ -0,0 +1,87 @@
+import logging
+import os
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+
+from aviatracker import utils
+from aviatracker.database import DB, CALLSIGNS_CHANNEL, STATES_CHANNEL, callsign_cache
+from aviatracker.metrics import Histogram, start_http_server_from_env
+from aviatracker.pipeline import PostgresSnapshotListener
+from aviatracker.web.delta import DeltaStream
+from aviatracker.web.snapshot import StateSnapshot
+from aviatracker.web.ticks import SOCKET_VARIABLE, Tick, TickPublisher
+
+
+logger = logging.getLogger()
+
+SNAPSHOT_TIMEOUT = 30
+
+TICK_SECONDS = Histogram("aviatracker_tick_seconds", "Duration of reading a snapshot of states and publishing its tick")
+
+
+def read_snapshot(db: DB) -> Optional[StateSnapshot]:
+    """Reads the current states along with the airports of their callsigns"""
+    with db:
+        callsign_cache.refresh(db)
+        vectors: Optional[List[Dict]] = db.get_current_states()
+        if vectors is None:
+            return None
+        for vector in vectors:
+            airports: Optional[Tuple[str, str]] = callsign_cache.get_airports(db, vector["callsign"])
+            if airports:
+                vector["est_arrival_airport"], vector["est_departure_airport"] = airports
+    return StateSnapshot(vectors[0]["request_time"], vectors)
+
+
+def produce_ticks(params: Dict[str, Any], publish: Callable[[Tick], None], delta: bool = True) -> None:
+    """Reads the current states whenever the ingest announces a new snapshot of them and publishes its tick.
+    With delta the clients receive only the changes since the previous tick and a periodic keyframe."""
+    stream = DeltaStream() if delta else None
+    last_time: Optional[int] = None
+    with closing(DB(**params)) as db:
+        listener = PostgresSnapshotListener(db, (STATES_CHANNEL, CALLSIGNS_CHANNEL))
+        with db:
+            snapshot_time: Optional[int] = db.get_current_states_request_time()
+        while True:
+            if snapshot_time is not None:
+                start = time.perf_counter()
+                snapshot = read_snapshot(db)
+                if snapshot is not None:
+                    publish(Tick.build(snapshot, stream))
+                    last_time = snapshot.request_time
+                    TICK_SECONDS.observe(time.perf_counter() - start)
+                    logger.info(f"{snapshot.size} states fetched from the DB for the time {snapshot.request_time}")
+                    logger.info(f"callsign cache: {callsign_cache.stats()}")
+                    callsign_cache.reset_stats()
+
+            notifications = listener.wait(SNAPSHOT_TIMEOUT)
+            if CALLSIGNS_CHANNEL in {channel for channel, _ in notifications}:
+                callsign_cache.invalidate()
+            snapshot_time = listener.latest_snapshot(notifications)
+            if snapshot_time is not None and last_time is not None and snapshot_time <= last_time:
+                snapshot_time = None
+
+
+@click.command(name="snapshot-producer")
+@click.option("--socket", "path", default=None, help=f"Unix socket of the web workers, ${SOCKET_VARIABLE} by default")
+def snapshot_producer(path: Optional[str]) -> None:
+    """Reads every snapshot of states once and publishes it encoded to the web workers started with the same socket"""
+    from aviatracker.config import common_conf
+
+    path = path or os.environ.get(SOCKET_VARIABLE)
+    if not path:
+        raise click.UsageError(f"either --socket or ${SOCKET_VARIABLE} should be set")
+    utils.setup_logging()
+    start_http_server_from_env()
+    publisher = TickPublisher(path)
+    try:
+        produce_ticks(common_conf.db_params, publisher.publish)
+    finally:
+        publisher.close()
+
+
+if __name__ == "__main__":
+    snapshot_producer()
@@ -0,0 +1,81 @@
+import math
+from array import array
+from typing import Dict, List, Optional
+
+from aviatracker.web.wire import JSON_FORMAT, Message, WireFormat
+
+
+class StringTable:
+    """Interns the strings of a snapshot: every distinct string is stored once and referenced by its index"""
+
+    def __init__(self) -> None:
+        self.strings: List[str] = []
+        self._indexes: Dict[str, int] = {}
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        index = self._indexes.get(value)
+        if index is None:
+            index = len(self.strings)
+            self._indexes[value] = index
+            self.strings.append(value)
+        return index
+
+    def get(self, index: int) -> Optional[str]:
+        return self.strings[index] if index >= 0 else None
+
+
+class StateSnapshot:
+    """Columnar snapshot of the current aircraft states, limited to the fields used by the map.
+    Floats are kept in array columns with NaN for missing values, strings are references to an interned table.
+    The snapshot is built once per DB poll and encoded once, however many clients it is sent to."""
+
+    float_columns = ("longitude", "latitude", "baro_altitude", "velocity", "true_track")
+    string_columns = ("icao24", "callsign", "origin_country", "est_arrival_airport", "est_departure_airport")
+    # order of the values in the row-oriented messages, icao24 goes first as the key of an aircraft
+    row_fields = string_columns + float_columns
+
+    def __init__(self, request_time: int, vectors: List[Dict]) -> None:
+        self.request_time = request_time
+        self.size = len(vectors)
+        self.strings = StringTable()
+        self.floats: Dict[str, array] = {name: array("d") for name in self.float_columns}
+        self.refs: Dict[str, array] = {name: array("i") for name in self.string_columns}
+        self._message: Optional[Message] = None
+
+        for vector in vectors:
+            for name, column in self.floats.items():
+                value = vector.get(name)
+                column.append(math.nan if value is None else value)
+            for name, refs in self.refs.items():
+                refs.append(self.strings.add(vector.get(name)))
+
+    def row(self, index: int) -> Dict:
+        aircraft: Dict = {name: self.strings.get(refs[index]) for name, refs in self.refs.items()}
+        for name, column in self.floats.items():
+            value = column[index]
+            aircraft[name] = None if math.isnan(value) else value
+        return aircraft
+
+    def message(self) -> Message:
+        """Returns the snapshot as a message, the columns are converted only on the first call"""
+        if self._message is None:
+            self._message = Message(
+                {
+                    "type": "snapshot",
+                    "request_time": self.request_time,
+                    "size": self.size,
+                    "strings": self.strings.strings,
+                    "string_columns": {name: refs.tolist() for name, refs in self.refs.items()},
+                    "float_columns": {
+                        name: [None if math.isnan(value) else value for value in column]
+                        for name, column in self.floats.items()
+                    },
+                }
+            )
+        return self._message
+
+    def encode(self, wire: WireFormat = JSON_FORMAT) -> bytes:
+        """Returns the snapshot encoded in the wire format, it is serialized once per format"""
+        return self.message().encode(wire)
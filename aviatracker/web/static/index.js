@@ -20,9 +20,14 @@ require([
         yMax: 0
     };
     let addStarts;
+    let aircraftStates = {};
+    let statesVersion = null;
+    let keyframeRequested = false;
+    let currentFlight = null;
 
     const url = document.getElementById('url');
     const urlAttr= url.getAttribute('url');
+    const airportsUrl = document.getElementById('airports-url').getAttribute('url');
 
     let map = new Map({
         basemap: "dark-gray-vector"
@@ -417,6 +422,44 @@ require([
         popupTemplate: pathPopup
     });
 
+    let densityRenderer = {
+        type: "simple",
+        symbol: {
+            type: "simple-marker",
+            color: [123, 229, 224, 0.4],
+            outline: {
+                width: 0
+            }
+        },
+        visualVariables: [{
+            type: "size",
+            field: "count",
+            stops: [
+                {value: 1, size: 4},
+                {value: 300, size: 30}
+            ]
+        }]
+    };
+
+    let densityFeatureLayer = new FeatureLayer({
+        source: [],
+        fields: [
+            {
+                name: "objectID",
+                type: "oid"
+            }, {
+                name: "count",
+                type: "integer"
+            }
+        ],
+        objectIdField: "objectID",
+        renderer: densityRenderer,
+        geometryType: "point",
+        spatialReference: {
+            wkid: 3857
+        }
+    });
+
     const graphic = {
         popupTemplate: {
             title: "Mouse over aircrafts to show details..."
@@ -483,6 +526,8 @@ require([
     map.add(airportFeatureLayer);
     removeFeatures([], airportFeatureLayer);
 
+    map.add(densityFeatureLayer);
+
     map.add(featureLayer);
     removeFeatures([], featureLayer);
 
@@ -636,11 +681,206 @@ require([
         await addFeatures(addObjects, airportFeatureLayer);
     }
 
+    // the binary wire format of the server, see aviatracker/web/wire.py
+    const PLAIN = 0xB1, DEFLATED = 0xB2, JSON_START = 0x7B;
+    const MESSAGE_TYPES = {1: "keyframe", 2: "delta", 3: "snapshot", 4: "tile", 5: "density", 6: "flight"};
+    const STRING = 0, FIXED32 = 1, FIXED16 = 2;
+    const NULL_FIXED32 = -(2 ** 31), NULL_FIXED16 = 2 ** 16 - 1;
+    const wireDecoder = new TextDecoder();
+
+    async function inflate (bytes) {
+        let stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+
+    async function decodeMessage (buffer) {
+        let bytes = new Uint8Array(buffer);
+        if (bytes[0] === JSON_START) {
+            return JSON.parse(wireDecoder.decode(bytes));
+        }
+        if (bytes[0] === DEFLATED) {
+            return parseBinary(await inflate(bytes.subarray(1)));
+        }
+        return parseBinary(bytes.subarray(1));
+    }
+
+    function parseBinary (bytes) {
+        let view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+        let u8 = () => { offset += 1; return view.getUint8(offset - 1); };
+        let u16 = () => { offset += 2; return view.getUint16(offset - 2, true); };
+        let u32 = () => { offset += 4; return view.getUint32(offset - 4, true); };
+        let i32 = () => { offset += 4; return view.getInt32(offset - 4, true); };
+        let f32 = () => { offset += 4; return view.getFloat32(offset - 4, true); };
+        let text = size => { offset += size; return wireDecoder.decode(bytes.subarray(offset - size, offset)); };
+
+        let schema = null;
+        function readSchema () {
+            let fields = [], kinds = [], scales = [];
+            let quantity = u8();
+            for (let i = 0; i < quantity; i ++) {
+                fields.push(text(u8()));
+                kinds.push(u8());
+                scales.push(f32());
+            }
+            let strings = [];
+            let stringsQuantity = u32();
+            let refSize = u8();
+            for (let i = 0; i < stringsQuantity; i ++) {
+                strings.push(text(u8()));
+            }
+            schema = {fields, kinds, scales, strings, refSize};
+        }
+        function readValue (index) {
+            let kind = schema.kinds[index];
+            if (kind === FIXED32) {
+                let value = i32();
+                return value === NULL_FIXED32 ? null : value / schema.scales[index];
+            }
+            if (kind === FIXED16) {
+                let value = u16();
+                return value === NULL_FIXED16 ? null : value / schema.scales[index];
+            }
+            return readString();
+        }
+        function readString () {
+            let ref = schema.refSize === 2 ? u16() : u32();
+            return ref < schema.strings.length ? schema.strings[ref] : null;
+        }
+        function readRows () {
+            let rows = [];
+            let quantity = u32();
+            for (let i = 0; i < quantity; i ++) {
+                let mask = u16();
+                rows.push(schema.fields.map((name, index) => (mask & (1 << index)) ? readValue(index) : null));
+            }
+            return rows;
+        }
+        function readChanges () {
+            let changes = [];
+            let quantity = u32();
+            for (let i = 0; i < quantity; i ++) {
+                let mask = u16();
+                let fields = {};
+                schema.fields.forEach((name, index) => {
+                    if (mask & (1 << index)) {
+                        fields[name] = readValue(index);
+                    }
+                });
+                let icao = fields[schema.fields[0]];
+                delete fields[schema.fields[0]];
+                changes.push([icao, fields]);
+            }
+            return changes;
+        }
+
+        let message = {type: MESSAGE_TYPES[u8()]};
+        if (message.type === "keyframe") {
+            message.version = u32();
+            readSchema();
+            message.fields = schema.fields;
+            message.aircraft = readRows();
+        } else if (message.type === "delta") {
+            message.version = u32();
+            message.base = u32();
+            readSchema();
+            message.fields = schema.fields;
+            message.added = readRows();
+            message.removed = [];
+            let removed = u32();
+            for (let i = 0; i < removed; i ++) {
+                message.removed.push(readString());
+            }
+            message.changed = readChanges();
+        } else if (message.type === "snapshot" || message.type === "tile") {
+            if (message.type === "snapshot") {
+                message.request_time = u32();
+            } else {
+                message.cell = [u16(), u16()];
+            }
+            readSchema();
+            message.fields = schema.fields;
+            message.aircraft = readRows();
+        } else if (message.type === "density") {
+            message.cell_size = f32();
+            message.cells = [];
+            let quantity = u32();
+            for (let i = 0; i < quantity; i ++) {
+                message.cells.push([f32(), f32(), u32()]);
+            }
+        } else if (message.type === "flight") {
+            Object.assign(message, JSON.parse(text(u32())));
+            let scale = f32();
+            let quantity = u32();
+            message.path = [];
+            for (let i = 0; i < quantity; i ++) {
+                let longitude = i32(), latitude = i32();
+                message.path.push(longitude === NULL_FIXED32 ? {longitude: null, latitude: null}
+                    : {longitude: longitude / scale, latitude: latitude / scale});
+            }
+        }
+        return message;
+    }
+
+    function decodeSnapshot (snapshot) {
+        let aircraft = [];
+        for (let i = 0; i < snapshot.size; i ++) {
+            let item = {};
+            Object.keys(snapshot.string_columns).forEach(name => {
+                let ref = snapshot.string_columns[name][i];
+                item[name] = ref >= 0 ? snapshot.strings[ref] : null;
+            });
+            Object.keys(snapshot.float_columns).forEach(name => {
+                item[name] = snapshot.float_columns[name][i];
+            });
+            aircraft.push(item);
+        }
+        return aircraft;
+    }
+
+    function rowToAircraft (fields, values) {
+        let item = {};
+        fields.forEach((name, i) => {
+            item[name] = values[i];
+        });
+        return item;
+    }
+
     function updateAircraft (aircraft) {
         buckets = bucketize(aircraft);
         render(buckets, extentCoords);
     }
 
+    async function drawDensity (density) {
+        let addObjects = [];
+        density.cells.forEach(cell => {
+            addObjects.push(new Graphic({
+                geometry: {
+                    type: "point",
+                    longitude: cell[0],
+                    latitude: cell[1]
+                },
+                attributes: {
+                    count: cell[2]
+                }
+            }));
+        });
+        await removeFeatures([], densityFeatureLayer);
+        await addFeatures(addObjects, densityFeatureLayer);
+    }
+
+    async function updateViewport (tiles) {
+        let aircraft = [];
+        for (const buffer of tiles) {
+            let tile = await decodeMessage(buffer);
+            tile.aircraft.forEach(values => {
+                aircraft.push(rowToAircraft(tile.fields, values));
+            });
+        }
+        removeFeatures([], densityFeatureLayer);
+        updateAircraft(aircraft);
+    }
+
     function pathToGraphics (path, flight) {
         let traveledPath = {
             type: "polyline",
@@ -718,17 +958,52 @@ require([
                 }
             })
 
-            if (x !== null && y !== null) {
-                traveledPath.push([x, y]);
-            }
+            currentFlight = {
+                icao24: flight.icao24,
+                callsign: flight.callsign,
+                path_id: flight.path_id,
+                last_point_id: flight.last_point_id,
+                path: traveledPath,
+                // the clicked point ends the path until the next points of the path arrive
+                tail: (x !== null && y !== null) ? [x, y] : null
+            };
+            await drawFlightPath(currentFlight);
+        }
+    }
 
-            let pathGraphic = pathToGraphics(traveledPath, flight);
+    async function extendFlight (update) {
+        if (currentFlight === null || update.icao24 !== currentFlight.icao24) {
+            return;
+        }
+        if (update.full) {
+            await renderFlight(update, null, null);
+            return;
+        }
+        if (update.path.length === 0) {
+            return;
+        }
+        update.path.forEach(point => {
+            if (point.longitude !== null && point.latitude !== null) {
+                currentFlight.path.push([point.longitude, point.latitude]);
+            }
+        });
+        currentFlight.last_point_id = update.last_point_id;
+        currentFlight.tail = null;
+        await drawFlightPath(currentFlight);
+    }
 
-            let addObjects = [];
-            addObjects.push(pathGraphic);
-            await removeFeatures([], traveledPathFeatureLayer);
-            await addFeatures(addObjects, traveledPathFeatureLayer);
+    async function drawFlightPath (flight) {
+        let traveledPath = flight.path.slice();
+        if (flight.tail !== null) {
+            traveledPath.push(flight.tail);
         }
+
+        let pathGraphic = pathToGraphics(traveledPath, flight);
+
+        let addObjects = [];
+        addObjects.push(pathGraphic);
+        await removeFeatures([], traveledPathFeatureLayer);
+        await addFeatures(addObjects, traveledPathFeatureLayer);
     }
 
     $(document).ready(function(){
@@ -736,33 +1011,105 @@ require([
 
         socket.on('connect', () => {
             console.log('client: connected');
-            socket.send("Ready to draw the airports");
+            // the binary format is deflated only when the browser can inflate it
+            socket.send(["format", "bin1", typeof DecompressionStream !== "undefined"]);
+            // the catalog is served over HTTP to be cached by the browser, the socket is the fallback
+            fetch(airportsUrl).then(response => response.json()).then(airports => {
+                drawAirports(["airports", airports]);
+            }).catch(() => {
+                socket.send("Ready to draw the airports");
+            });
         });
 
-        socket.on("message", data => {
-            if (data !== undefined) {
+        function applyStates (message) {
+            if (message.type === "keyframe") {
+                aircraftStates = {};
+                message.aircraft.forEach(values => {
+                    let item = rowToAircraft(message.fields, values);
+                    aircraftStates[item.icao24] = item;
+                });
+                statesVersion = message.version;
+                keyframeRequested = false;
+            } else if (message.type === "density") {
+                updateAircraft([]);
+                drawDensity(message);
+                return;
+            } else if (message.type === "delta") {
+                if (statesVersion === null || message.base !== statesVersion) {
+                    // a delta has been missed, the changes can only be applied to a fresh keyframe
+                    statesVersion = null;
+                    if (!keyframeRequested) {
+                        keyframeRequested = true;
+                        socket.send(["keyframe"]);
+                    }
+                    return;
+                }
+                message.added.forEach(values => {
+                    let item = rowToAircraft(message.fields, values);
+                    aircraftStates[item.icao24] = item;
+                });
+                message.removed.forEach(icao => {
+                    delete aircraftStates[icao];
+                });
+                message.changed.forEach(change => {
+                    Object.assign(aircraftStates[change[0]], change[1]);
+                });
+                statesVersion = message.version;
+            } else {
+                updateAircraft(message.aircraft ? message.aircraft.map(values => rowToAircraft(message.fields, values))
+                    : decodeSnapshot(message));
+                return;
+            }
+            updateAircraft(Object.values(aircraftStates));
+        }
+
+        async function decodeFlight (data) {
+            return data instanceof ArrayBuffer ? await decodeMessage(data) : data;
+        }
+
+        async function handleMessage (data) {
+            if (data instanceof ArrayBuffer) {
+                applyStates(await decodeMessage(data));
+            } else if (data !== undefined && data !== null) {
                 if (data[0] === "airports") {
                     drawAirports(data);
+                } else if (data[0] === "tiles") {
+                    await updateViewport(data.slice(1));
                 } else {
                     if (data[0][0] === "flight") {
                         if (data[1] !== null) {
-                            renderFlight(data[1], data[2], data[3]);
+                            renderFlight(await decodeFlight(data[1]), data[2], data[3]);
                         }
                     } else {
                         if (data[0] === "path-update") {
-                            renderFlight(data[1], null, null);
+                            extendFlight(await decodeFlight(data[1]));
                         } else {
                             updateAircraft(data);
                         }
                     }
                 }
             }
+        }
+
+        // inflating is asynchronous, the messages are still handled in the order of their arrival
+        let received = Promise.resolve();
+        socket.on("message", data => {
+            received = received.then(() => handleMessage(data)).catch(error => console.error(error));
+        });
+
+        watchUtils.whenTrue(view, "stationary", function() {
+            if (view.extent) {
+                // the server sends only the aircraft within the extent, or their density at low zoom
+                let extent = webMercatorUtils.webMercatorToGeographic(view.extent, false);
+                socket.send(["subscribe", extent.xmin, extent.ymin, extent.xmax, extent.ymax, view.zoom]);
+            }
         });
 
         view.whenLayerView(featureLayer).then(function (layerView) {
             view.on("click", function (event) {
 
                 removeFeatures([], traveledPathFeatureLayer);
+                currentFlight = null;
 
                 let screenPoint = {
                     x: event.x,
@@ -784,20 +1131,17 @@ require([
                             screenPoint.x = mp.x;
                             screenPoint.y = mp.y;
 
-                            socket.send(["icao24", icao, screenPoint.x, screenPoint.y])
+                            socket.send(["icao24", icao, screenPoint.x, screenPoint.y, view.zoom])
                         }
                     }
                 });
             });
         });
 
-        async function queryPath () {
-            let results = await traveledPathFeatureLayer.queryFeatures();
-            let features = results.features;
-
-            if (features.length !== 0) {
-                let icao = features[0].attributes.icao24;
-                let message = ["path-update", icao]
+        function queryPath () {
+            if (currentFlight !== null) {
+                // only the points appended after the last known one are sent back
+                let message = ["path-update", currentFlight.icao24, currentFlight.path_id, currentFlight.last_point_id];
                 socket.send(message);
             }
         }
@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from aviatracker.metrics import Counter, Gauge
+from aviatracker.web.delta import DeltaStream
+from aviatracker.web.snapshot import StateSnapshot
+from aviatracker.web.viewport import Cell, EncodedTiles, TileGrid, TileIndex
+from aviatracker.web.wire import WIRE_FORMATS, EncodedMessage, Message, WireFormat
+
+
+logger = logging.getLogger()
+
+SOCKET_VARIABLE = "AVIATRACKER_TICKS_SOCKET"
+
+# a frame is the size of the tick followed by the tick, a tick is the size of its JSON header,
+# the header and the messages in the order of the parts of the header;
+# a part of size -1 is the same bytes as the previous part, small messages are not deflated for instance
+SIZE = struct.Struct("<I")
+SAME = -1
+
+TICK_SUBSCRIBERS = Gauge("aviatracker_tick_subscribers", "Web workers receiving the ticks of the snapshot producer")
+TICK_BYTES = Counter("aviatracker_tick_bytes_total", "Bytes of the ticks published to the web workers")
+
+
+class Tick:
+    """Messages of a snapshot of states for the clients of the web app. It is built from the snapshot in the process
+    or received already encoded from the snapshot producer, a web worker only sends it to its clients either way."""
+
+    def __init__(
+        self,
+        request_time: int,
+        version: int,
+        base: Optional[int],
+        broadcast: Message,
+        keyframe: Message,
+        tiles: TileGrid,
+    ) -> None:
+        self.request_time = request_time
+        self.version = version
+        self.base = base
+        self.broadcast = broadcast
+        self.keyframe = keyframe
+        self.tiles = tiles
+
+    @classmethod
+    def build(cls, snapshot: StateSnapshot, stream: Optional[DeltaStream] = None) -> "Tick":
+        """With a stream the broadcast is the delta from its previous snapshot, otherwise the whole snapshot"""
+        tiles = TileIndex(snapshot)
+        if stream is None:
+            message = snapshot.message()
+            return cls(snapshot.request_time, 0, None, message, message, tiles)
+        base = stream.version
+        broadcast = stream.advance(snapshot)
+        return cls(snapshot.request_time, stream.version, base, broadcast, stream.keyframe(), tiles)
+
+    def broadcast_after(self, version: Optional[int]) -> Message:
+        """Returns the broadcast for the clients which have got the tick of the version,
+        that is the keyframe if a tick has been missed in between"""
+        if self.base is None or self.base == version:
+            return self.broadcast
+        return self.keyframe
+
+    def encode(self, formats: Tuple[WireFormat, ...] = WIRE_FORMATS) -> bytes:
+        """Encodes all messages of the tick in the formats, the broadcast is left out if it is the keyframe"""
+        messages: List[Tuple[str, Message]] = [("keyframe", self.keyframe), ("density", self.tiles.density())]
+        if self.broadcast is not self.keyframe:
+            messages.append(("broadcast", self.broadcast))
+        messages.extend((f"tile:{column}:{row}", self.tiles.payload((column, row))) for column, row in self.tiles.cells)
+
+        parts: List[Tuple[str, str, int]] = []
+        blobs: List[bytes] = []
+        for name, message in messages:
+            previous: Optional[bytes] = None
+            for wire in formats:
+                blob = message.encode(wire)
+                if blob == previous:
+                    parts.append((name, wire.key, SAME))
+                    continue
+                parts.append((name, wire.key, len(blob)))
+                blobs.append(blob)
+                previous = blob
+        header = {
+            "request_time": self.request_time,
+            "version": self.version,
+            "base": self.base,
+            "cell_size": self.tiles.cell_size,
+            "parts": parts,
+        }
+        encoded_header = json.dumps(header, separators=(",", ":")).encode()
+        return b"".join([SIZE.pack(len(encoded_header)), encoded_header] + blobs)
+
+    @classmethod
+    def decode(cls, data: bytes) -> "Tick":
+        (header_size,) = SIZE.unpack_from(data)
+        offset = SIZE.size + header_size
+        header = json.loads(data[SIZE.size : offset])
+        formats = {wire.key: wire for wire in WIRE_FORMATS}
+        encoded: Dict[str, Dict[WireFormat, bytes]] = {}
+        previous = b""
+        for name, key, size in header["parts"]:
+            if size != SAME:
+                previous = data[offset : offset + size]
+                offset += size
+            encoded.setdefault(name, {})[formats[key]] = previous
+
+        messages = {name: EncodedMessage(blobs) for name, blobs in encoded.items()}
+        keyframe = messages.pop("keyframe")
+        broadcast = messages.pop("broadcast", keyframe)
+        density = messages.pop("density")
+        payloads: Dict[Cell, Message] = {}
+        for name, message in messages.items():
+            _, column, row = name.split(":")
+            payloads[(int(column), int(row))] = message
+        tiles = EncodedTiles(header["cell_size"], payloads, density)
+        return cls(header["request_time"], header["version"], header["base"], broadcast, keyframe, tiles)
+
+
+class _Subscriber:
+    """A web worker subscribed to the ticks. Its own thread sends it the latest frame,
+    the frames published while it was still taking the previous one are skipped."""
+
+    def __init__(
+        self, connection: socket.socket, frame: Optional[bytes], on_close: Callable[["_Subscriber"], None]
+    ) -> None:
+        self.connection = connection
+        self._frame = frame
+        self._closed = False
+        self._on_close = on_close
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def offer(self, frame: bytes) -> None:
+        with self._condition:
+            self._frame = frame
+            self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self._frame is None and not self._closed:
+                    self._condition.wait()
+                frame, self._frame = self._frame, None
+                if self._closed or frame is None:
+                    return
+            try:
+                self.connection.sendall(frame)
+            except OSError as e:
+                logger.warning(f"A web worker has been disconnected from the ticks: {e}")
+                self.connection.close()
+                self._on_close(self)
+                return
+            TICK_BYTES.inc(len(frame))
+
+
+class TickPublisher:
+    """Publishes the ticks to the web workers connected to a Unix socket, every tick is encoded once for all of them.
+    A worker gets the latest tick as soon as it connects and then only the latest one whenever it is ready for more,
+    so a slow worker delays neither the producer nor the other workers. A worker which has not taken a tick
+    within send_timeout seconds is disconnected, it reconnects and starts over from the latest tick."""
+
+    def __init__(self, path: str, send_timeout: float = 5.0) -> None:
+        self.path = path
+        self.send_timeout = send_timeout
+        self._latest: Optional[bytes] = None
+        self._subscribers: List[_Subscriber] = []
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        logger.info(f"Ticks are published on {path}")
+
+    def publish(self, tick: Tick) -> None:
+        encoded = tick.encode()
+        frame = SIZE.pack(len(encoded)) + encoded
+        with self._lock:
+            self._latest = frame
+            for subscriber in self._subscribers:
+                subscriber.offer(frame)
+
+    def close(self) -> None:
+        self._server.close()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            connection.settimeout(self.send_timeout)
+            with self._lock:
+                self._subscribers.append(_Subscriber(connection, self._latest, self._remove))
+                TICK_SUBSCRIBERS.set(len(self._subscribers))
+            logger.info("A web worker has subscribed to the ticks")
+
+    def _remove(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            TICK_SUBSCRIBERS.set(len(self._subscribers))
+
+
+def _receive(connection: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("the publisher has closed the connection")
+        received += count
+    return bytes(buffer)
+
+
+class TickSubscriber:
+    """Receives the ticks of a TickPublisher, it reconnects whenever the connection is lost"""
+
+    def __init__(self, path: str, reconnect_interval: float = 1.0) -> None:
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+
+    def ticks(self) -> Iterator[Tick]:
+        while True:
+            try:
+                with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as connection:
+                    connection.connect(self.path)
+                    logger.info(f"Subscribed to the ticks of {self.path}")
+                    while True:
+                        (size,) = SIZE.unpack(_receive(connection, SIZE.size))
+                        yield Tick.decode(_receive(connection, size))
+            except OSError as e:
+                logger.warning(f"The ticks of {self.path} are unavailable: {e}")
+            time.sleep(self.reconnect_interval)
+
+
+class LocalTickChannel:
+    """In-process stand-in for a TickPublisher and its subscriber, the ticks are passed on without encoding.
+    A reader gets only the latest tick, the ones published while it was busy are skipped."""
+
+    def __init__(self) -> None:
+        self._tick: Optional[Tick] = None
+        self._condition = threading.Condition()
+
+    def publish(self, tick: Tick) -> None:
+        with self._condition:
+            self._tick = tick
+            self._condition.notify_all()
+
+    def ticks(self) -> Iterator[Tick]:
+        last: Optional[Tick] = None
+        while True:
+            with self._condition:
+                while self._tick is None or self._tick is last:
+                    self._condition.wait()
+                last = self._tick
+            yield last
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Sequence, Tuple
+
+
+Point = Tuple[float, float]
+
+
+def tolerance_for_zoom(zoom: float) -> float:
+    """Returns the size of a screen pixel in degrees at the zoom level of a web map with 256 pixel tiles"""
+    return 360 / (256 * 2 ** max(zoom, 0))
+
+
+def _distance_to_segment(point: Point, start: Point, end: Point) -> float:
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    if dx == 0 and dy == 0:
+        return ((point[0] - start[0]) ** 2 + (point[1] - start[1]) ** 2) ** 0.5
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / (dx * dx + dy * dy)
+    t = min(max(t, 0.0), 1.0)
+    x, y = start[0] + t * dx, start[1] + t * dy
+    return ((point[0] - x) ** 2 + (point[1] - y) ** 2) ** 0.5
+
+
+def simplify(points: Sequence[Point], tolerance: float) -> List[Point]:
+    """Douglas-Peucker simplification of a polyline, the points farther than tolerance from the simplified line
+    are kept. It is iterative, so long paths do not hit the recursion limit."""
+    if len(points) < 3:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, max_distance = 0, 0.0
+        for index in range(first + 1, last):
+            distance = _distance_to_segment(points[index], points[first], points[last])
+            if distance > max_distance:
+                farthest, max_distance = index, distance
+        if max_distance > tolerance:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class SimplifiedPathCache:
+    """LRU cache of simplified paths. The key should change whenever the path does, e.g. contain its last point."""
+
+    def __init__(self, max_size: int = 512) -> None:
+        self.max_size = max_size
+        self._paths: "OrderedDict[Hashable, List[Point]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[List[Point]]:
+        with self._lock:
+            path = self._paths.get(key)
+            if path is not None:
+                self._paths.move_to_end(key)
+            return path
+
+    def put(self, key: Hashable, path: List[Point]) -> None:
+        with self._lock:
+            self._paths[key] = path
+            self._paths.move_to_end(key)
+            if len(self._paths) > self.max_size:
+                self._paths.popitem(last=False)
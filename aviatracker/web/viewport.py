@@ -0,0 +1,156 @@
+import math
+from abc import ABC, abstractmethod
+from array import array
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from aviatracker.web.snapshot import StateSnapshot
+from aviatracker.web.wire import Message
+
+
+Cell = Tuple[int, int]
+
+# zoom levels of web maps, a client reporting a zoom beyond them is taken at the nearest one
+MIN_ZOOM, MAX_ZOOM = 0.0, 24.0
+
+
+class Viewport(NamedTuple):
+    """Map extent of a client in degrees together with the zoom level of its map"""
+
+    min_longitude: float
+    min_latitude: float
+    max_longitude: float
+    max_latitude: float
+    zoom: float
+
+
+def parse_zoom(value: Any) -> Optional[float]:
+    """Returns the zoom level sent by a client within the zoom levels of web maps, None if it is not a number"""
+    try:
+        zoom = float(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(zoom, MIN_ZOOM), MAX_ZOOM) if math.isfinite(zoom) else None
+
+
+def parse_viewport(values: Sequence[Any]) -> Optional[Viewport]:
+    """Returns the viewport sent by a client as its extent and zoom, None if they are not five finite numbers.
+    The latitudes are clamped to the poles and the longitudes to two turns, the grid wraps them around anyway."""
+    if len(values) != len(Viewport._fields):
+        return None
+    try:
+        numbers = [float(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+    if not all(math.isfinite(number) for number in numbers):
+        return None
+    min_longitude, min_latitude, max_longitude, max_latitude, zoom = numbers
+    return Viewport(
+        min(max(min_longitude, -360.0), 360.0),
+        min(max(min_latitude, -90.0), 90.0),
+        min(max(max_longitude, -360.0), 360.0),
+        min(max(max_latitude, -90.0), 90.0),
+        min(max(zoom, MIN_ZOOM), MAX_ZOOM),
+    )
+
+
+class TileGrid(ABC):
+    """Grid of cell_size x cell_size degree cells, the clients get the payloads of the cells within their viewports"""
+
+    def __init__(self, cell_size: float) -> None:
+        self.cell_size = cell_size
+        self.cells: Dict[Cell, Any] = {}
+
+    def cell_of(self, longitude: float, latitude: float) -> Cell:
+        columns, rows = int(360 / self.cell_size), int(180 / self.cell_size)
+        column = min(int((longitude + 180) // self.cell_size), columns - 1)
+        row = min(int((latitude + 90) // self.cell_size), rows - 1)
+        return column % columns, max(row, 0)
+
+    def cells_in(self, viewport: Viewport) -> List[Cell]:
+        """Returns the non-empty cells intersecting the viewport, the antimeridian may lie inside of it"""
+        min_latitude = max(viewport.min_latitude, -90.0)
+        max_latitude = min(viewport.max_latitude, 90.0)
+        if viewport.max_longitude - viewport.min_longitude >= 360:
+            ranges = [(-180.0, 180.0)]
+        else:
+            west = (viewport.min_longitude + 180) % 360 - 180
+            east = (viewport.max_longitude + 180) % 360 - 180
+            ranges = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+
+        cells: List[Cell] = []
+        for west, east in ranges:
+            min_column, min_row = self.cell_of(west, min_latitude)
+            max_column, max_row = self.cell_of(east, max_latitude)
+            for column in range(min_column, max_column + 1):
+                for row in range(min_row, max_row + 1):
+                    if (column, row) in self.cells:
+                        cells.append((column, row))
+        return cells
+
+    @abstractmethod
+    def payload(self, cell: Cell) -> Message:
+        """Returns the states of the aircraft within the cell"""
+
+    @abstractmethod
+    def density(self) -> Message:
+        """Returns the quantity of aircraft per cell along with the center of the cell"""
+
+
+class TileIndex(TileGrid):
+    """Grid over the aircraft of a snapshot, it is rebuilt for every snapshot.
+    The payload of a cell is encoded once per wire format and shared by all clients whose viewports
+    cover the cell, the same goes for the density payload sent to the clients at low zoom."""
+
+    def __init__(self, snapshot: StateSnapshot, cell_size: float = 5.0) -> None:
+        super().__init__(cell_size)
+        self.snapshot = snapshot
+        self.cells: Dict[Cell, array] = {}
+        self._payloads: Dict[Cell, Message] = {}
+        self._density: Optional[Message] = None
+
+        longitudes, latitudes = snapshot.floats["longitude"], snapshot.floats["latitude"]
+        for index in range(snapshot.size):
+            longitude, latitude = longitudes[index], latitudes[index]
+            if math.isnan(longitude) or math.isnan(latitude):
+                continue
+            cell = self.cell_of(longitude, latitude)
+            if cell not in self.cells:
+                self.cells[cell] = array("i")
+            self.cells[cell].append(index)
+
+    def payload(self, cell: Cell) -> Message:
+        if cell not in self._payloads:
+            rows = []
+            for index in self.cells.get(cell, []):
+                row = self.snapshot.row(index)
+                rows.append([row[name] for name in StateSnapshot.row_fields])
+            self._payloads[cell] = Message(
+                {"type": "tile", "cell": list(cell), "fields": StateSnapshot.row_fields, "aircraft": rows}
+            )
+        return self._payloads[cell]
+
+    def density(self) -> Message:
+        """Returns the quantity of aircraft per cell along with the center of the cell"""
+        if self._density is None:
+            half = self.cell_size / 2
+            cells = [
+                [column * self.cell_size - 180 + half, row * self.cell_size - 90 + half, len(indexes)]
+                for (column, row), indexes in self.cells.items()
+            ]
+            self._density = Message({"type": "density", "cell_size": self.cell_size, "cells": cells})
+        return self._density
+
+
+class EncodedTiles(TileGrid):
+    """Grid of the payloads received already encoded from the snapshot producer"""
+
+    def __init__(self, cell_size: float, payloads: Dict[Cell, Message], density: Message) -> None:
+        super().__init__(cell_size)
+        self.cells: Dict[Cell, Message] = payloads
+        self._density = density
+
+    def payload(self, cell: Cell) -> Message:
+        return self.cells[cell]
+
+    def density(self) -> Message:
+        return self._density
@@ -0,0 +1,258 @@
+import json
+import struct
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class WireFormat(NamedTuple):
+    """Encoding of the messages negotiated by a client, JSON unless it asks for the binary one"""
+
+    binary: bool = False
+    deflate: bool = False
+
+    @property
+    def key(self) -> str:
+        if not self.binary:
+            return "json"
+        return BINARY_VERSION + ("+deflate" if self.deflate else "")
+
+
+BINARY_VERSION = "bin1"
+JSON_FORMAT = WireFormat()
+# every format a client may negotiate, the snapshot producer encodes the ticks in all of them
+WIRE_FORMATS = (JSON_FORMAT, WireFormat(True), WireFormat(True, True))
+
+
+def parse_format(name: Any, deflate: Any = False) -> WireFormat:
+    return WireFormat(True, bool(deflate)) if name == BINARY_VERSION else JSON_FORMAT
+
+
+# The binary format, all numbers are little-endian:
+#   frame: u8 magic (PLAIN or DEFLATED, the rest is zlib-compressed then), u8 type, header of the type, body
+#   schema: u8 quantity of fields, then u8 length + name, u8 kind, f32 scale of every field
+#   strings: u32 quantity, u8 size of a reference (2 or 4), then u8 length + UTF-8 bytes of every string
+#   record: u16 mask of the fields present in the record, then the values of these fields in the schema order
+# Floats are sent as fixed-point integers, value * scale. The maximum of a type stands for null.
+PLAIN, DEFLATED = 0xB1, 0xB2
+TYPES = {"keyframe": 1, "delta": 2, "snapshot": 3, "tile": 4, "density": 5, "flight": 6}
+STRING, FIXED32, FIXED16 = 0, 1, 2
+FIELD_ENCODINGS = {
+    "longitude": (FIXED32, 1e5),
+    "latitude": (FIXED32, 1e5),
+    "baro_altitude": (FIXED32, 1.0),
+    "velocity": (FIXED16, 10.0),
+    "true_track": (FIXED16, 100.0),
+}
+NULL_FIXED32 = -(2 ** 31)
+NULL_FIXED16 = 2 ** 16 - 1
+PATH_SCALE = 1e5
+
+# messages shorter than that are not worth deflating
+DEFLATE_MIN_SIZE = 512
+
+# a null string reference is None until the size of the references is known
+Record = Tuple[int, List[Optional[int]]]
+
+
+def _fixed32(value: float, scale: float) -> int:
+    return max(min(round(value * scale), 2 ** 31 - 1), NULL_FIXED32 + 1)
+
+
+def _fixed16(value: float, scale: float) -> int:
+    return max(min(round(value * scale), NULL_FIXED16 - 1), 0)
+
+
+class RecordsWriter:
+    """Collects the records of a message and the strings they refer to, the records are packed when the size
+    of a string reference is known, that is when all of them have been collected"""
+
+    def __init__(self, fields: Sequence[str]) -> None:
+        self.fields = list(fields)
+        self.encodings = [FIELD_ENCODINGS.get(name, (STRING, 1.0)) for name in self.fields]
+        self.strings: List[bytes] = []
+        self._refs: Dict[str, int] = {}
+        self._structs: Dict[Tuple[int, int], struct.Struct] = {}
+
+    def ref(self, value: str) -> int:
+        ref = self._refs.get(value)
+        if ref is None:
+            ref = self._refs[value] = len(self.strings)
+            self.strings.append(value.encode()[:255])
+        return ref
+
+    def row(self, values: Sequence[Any]) -> Record:
+        """A record of all fields of an aircraft, the missing values are left out of it"""
+        mask = 0
+        numbers: List[Optional[int]] = []
+        for index, value in enumerate(values):
+            if value is None:
+                continue
+            mask |= 1 << index
+            numbers.append(self._number(index, value))
+        return mask, numbers
+
+    def change(self, changes: Dict[str, Any]) -> Record:
+        """A record of the changed fields only, a field changed to a missing value is sent as null"""
+        mask = 0
+        numbers: List[Optional[int]] = []
+        for index, name in enumerate(self.fields):
+            if name in changes:
+                mask |= 1 << index
+                value = changes[name]
+                numbers.append(self._null(index) if value is None else self._number(index, value))
+        return mask, numbers
+
+    def _number(self, index: int, value: Any) -> int:
+        kind, scale = self.encodings[index]
+        if kind == FIXED32:
+            return _fixed32(value, scale)
+        if kind == FIXED16:
+            return _fixed16(value, scale)
+        return self.ref(value)
+
+    def _null(self, index: int) -> Optional[int]:
+        kind, _ = self.encodings[index]
+        return NULL_FIXED32 if kind == FIXED32 else NULL_FIXED16 if kind == FIXED16 else None
+
+    @property
+    def ref_size(self) -> int:
+        return 2 if len(self.strings) < NULL_FIXED16 else 4
+
+    def write_header(self, body: bytearray) -> None:
+        body += struct.pack("<B", len(self.fields))
+        for name, (kind, scale) in zip(self.fields, self.encodings):
+            encoded = name.encode()
+            body += struct.pack("<B", len(encoded)) + encoded + struct.pack("<Bf", kind, scale)
+        body += struct.pack("<IB", len(self.strings), self.ref_size)
+        for string in self.strings:
+            body += struct.pack("<B", len(string)) + string
+
+    def write_records(self, body: bytearray, records: List[Record]) -> None:
+        ref_size = self.ref_size
+        null_ref = NULL_FIXED16 if ref_size == 2 else 2 ** 32 - 1
+        body += struct.pack("<I", len(records))
+        for mask, numbers in records:
+            packer = self._structs.get((mask, ref_size))
+            if packer is None:
+                codes = ["<H"]
+                for index, (kind, _) in enumerate(self.encodings):
+                    if mask & (1 << index):
+                        codes.append("i" if kind == FIXED32 else "H" if kind == FIXED16 or ref_size == 2 else "I")
+                packer = self._structs[(mask, ref_size)] = struct.Struct("".join(codes))
+            if None in numbers:
+                numbers = [null_ref if number is None else number for number in numbers]
+            body += packer.pack(mask, *numbers)
+
+    def write_refs(self, body: bytearray, refs: List[int]) -> None:
+        body += struct.pack(f"<I{len(refs)}{'H' if self.ref_size == 2 else 'I'}", len(refs), *refs)
+
+
+def _encode_rows(body: bytearray, fields: Sequence[str], rows: Sequence[Sequence[Any]]) -> None:
+    writer = RecordsWriter(fields)
+    records = [writer.row(values) for values in rows]
+    writer.write_header(body)
+    writer.write_records(body, records)
+
+
+def _encode_delta(body: bytearray, payload: Dict) -> None:
+    writer = RecordsWriter(payload["fields"])
+    added = [writer.row(values) for values in payload["added"]]
+    removed = [writer.ref(icao24) for icao24 in payload["removed"]]
+    changed = [writer.change({writer.fields[0]: icao24, **fields}) for icao24, fields in payload["changed"]]
+    writer.write_header(body)
+    writer.write_records(body, added)
+    writer.write_refs(body, removed)
+    writer.write_records(body, changed)
+
+
+def _snapshot_rows(payload: Dict) -> Tuple[List[str], List[List[Any]]]:
+    strings = payload["strings"]
+    string_columns = payload["string_columns"]
+    float_columns = payload["float_columns"]
+    fields = list(string_columns) + list(float_columns)
+    rows = []
+    for index in range(payload["size"]):
+        row = [strings[refs[index]] if refs[index] >= 0 else None for refs in string_columns.values()]
+        row.extend(column[index] for column in float_columns.values())
+        rows.append(row)
+    return fields, rows
+
+
+def encode_binary(payload: Dict) -> bytes:
+    """Returns the body of the binary frame of a message, the type of the message is its "type" key"""
+    message_type = payload["type"]
+    body = bytearray(struct.pack("<B", TYPES[message_type]))
+    if message_type == "keyframe":
+        body += struct.pack("<I", payload["version"])
+        _encode_rows(body, payload["fields"], payload["aircraft"])
+    elif message_type == "delta":
+        body += struct.pack("<II", payload["version"], payload["base"])
+        _encode_delta(body, payload)
+    elif message_type == "snapshot":
+        body += struct.pack("<I", payload["request_time"])
+        _encode_rows(body, *_snapshot_rows(payload))
+    elif message_type == "tile":
+        body += struct.pack("<HH", *payload["cell"])
+        _encode_rows(body, payload["fields"], payload["aircraft"])
+    elif message_type == "density":
+        cells = payload["cells"]
+        body += struct.pack("<fI", payload["cell_size"], len(cells))
+        for longitude, latitude, quantity in cells:
+            body += struct.pack("<ffI", longitude, latitude, quantity)
+    elif message_type == "flight":
+        header = json.dumps({key: value for key, value in payload.items() if key != "path"}).encode()
+        path = payload["path"]
+        body += struct.pack("<I", len(header)) + header + struct.pack("<fI", PATH_SCALE, len(path))
+        for point in path:
+            longitude, latitude = point["longitude"], point["latitude"]
+            if longitude is None or latitude is None:
+                body += struct.pack("<ii", NULL_FIXED32, NULL_FIXED32)
+            else:
+                body += struct.pack("<ii", _fixed32(longitude, PATH_SCALE), _fixed32(latitude, PATH_SCALE))
+    return bytes(body)
+
+
+def frame(body: bytes, deflate: bool) -> bytes:
+    if deflate and len(body) >= DEFLATE_MIN_SIZE:
+        return bytes((DEFLATED,)) + zlib.compress(body, 6)
+    return bytes((PLAIN,)) + body
+
+
+class Message:
+    """A message to clients encoded on demand, once per wire format however many clients it is sent to"""
+
+    def __init__(self, payload: Dict) -> None:
+        self.payload = payload
+        self._encoded: Dict[WireFormat, bytes] = {}
+        self._body: Optional[bytes] = None
+
+    def encode(self, wire: WireFormat = JSON_FORMAT) -> bytes:
+        encoded = self._encoded.get(wire)
+        if encoded is None:
+            if wire.binary:
+                # the body is shared by the plain and the deflated frames
+                if self._body is None:
+                    self._body = encode_binary(self.payload)
+                encoded = frame(self._body, wire.deflate)
+            else:
+                encoded = json.dumps(self.payload, separators=(",", ":")).encode()
+            self._encoded[wire] = encoded
+        return encoded
+
+
+def encode_flight(flight: Dict, wire: WireFormat) -> Any:
+    """Returns the flight as it is sent to the client, JSON clients get it as a part of the Socket.IO message"""
+    if not wire.binary:
+        return flight
+    return Message({**flight, "type": "flight"}).encode(wire)
+
+
+class EncodedMessage(Message):
+    """A message received already encoded in the formats of WIRE_FORMATS"""
+
+    def __init__(self, encoded: Dict[WireFormat, bytes]) -> None:
+        super().__init__({})
+        self._encoded = dict(encoded)
+
+    def encode(self, wire: WireFormat = JSON_FORMAT) -> bytes:
+        return self._encoded[wire]
@@ -2,8 +2,16 @@ rabbitmq-server -detached
 
 celery -A aviatracker.tasks beat --detach -l INFO -f logs/celery.log -s beat/celerybeat-schedule
 
-celery -A aviatracker.tasks worker --detach -l DEBUG -f logs/celery.log --without-gossip --without-mingle -n worker1@%h -Q states --concurrency=1
-celery -A aviatracker.tasks worker --detach -l INFO -f logs/celery.log --without-gossip --without-mingle -n worker2@%h -Q paths --concurrency=1
-celery -A aviatracker.tasks worker --detach -l INFO -f logs/celery.log --without-gossip --without-mingle -n worker3@%h -Q celery --concurrency=1
+AVIATRACKER_METRICS_PORT=9101 celery -A aviatracker.tasks worker --detach -l DEBUG -f logs/celery.log --without-gossip --without-mingle -n worker1@%h -Q states --concurrency=1
+AVIATRACKER_METRICS_PORT=9103 celery -A aviatracker.tasks worker --detach -l INFO -f logs/celery.log --without-gossip --without-mingle -n worker3@%h -Q celery --concurrency=1
 
+AVIATRACKER_METRICS_PORT=9102 nohup python3 -m aviatracker.pipeline >> logs/pipeline.log 2>&1 &
+
+# the snapshot producer reads every snapshot once for all web workers, the workers share the port with SO_REUSEPORT
+export AVIATRACKER_TICKS_SOCKET=/tmp/aviatracker-ticks.sock
+AVIATRACKER_METRICS_PORT=9104 nohup python3 -m aviatracker.web.producer >> logs/producer.log 2>&1 &
+
+for i in $(seq 2 "${WEB_WORKERS:-1}"); do
+    nohup python3 -m aviatracker.web.app >> logs/web$i.log 2>&1 &
+done
 python3 -m aviatracker.web.app
@@ -0,0 +1,45 @@
+import os
+import uuid
+from typing import Any, Dict, Iterator
+
+import psycopg2
+import pytest
+import yaml
+
+from aviatracker.database import DB
+
+
+@pytest.fixture
+def db_params() -> Dict[str, Any]:
+    try:
+        from aviatracker.config import common_conf
+    except (OSError, KeyError, TypeError):
+        pytest.skip("config/config.yaml is not set up")
+    try:
+        DB(**common_conf.db_params).close()
+    except psycopg2.Error as e:
+        pytest.skip(f"the DB is unreachable: {e}")
+    return common_conf.db_params
+
+
+@pytest.fixture
+def scratch_db(db_params: Dict[str, Any]) -> Iterator[DB]:
+    """A connection to the tables of make_tables.yaml created in a schema of their own, which is dropped afterwards"""
+    schema = f"aviatracker_test_{uuid.uuid4().hex[:8]}"
+    db = DB(**db_params)
+    try:
+        with db:
+            with db.conn.cursor() as curs:
+                curs.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema};")
+            db.set_timezone()
+        path = os.path.join(os.path.dirname(__file__), "..", "aviatracker", "scripts", "make_tables.yaml")
+        with open(path, "r") as f:
+            for script in yaml.load(f, Loader=yaml.FullLoader).values():
+                db.execute_script(script)
+        yield db
+    finally:
+        db.conn.rollback()
+        with db:
+            with db.conn.cursor() as curs:
+                curs.execute(f"DROP SCHEMA {schema} CASCADE")
+        db.close()
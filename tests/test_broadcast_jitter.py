@@ -0,0 +1,109 @@
+# run as a script, the test measures the broadcasts in a process patched by eventlet like the web app
+if __name__ == "__main__":
+    import eventlet
+
+    eventlet.monkey_patch()
+
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+from aviatracker.database import DB
+
+INTERVAL = 0.5
+SECONDS = 5.0
+LOCK_SECONDS = 1.0
+
+
+def test_green_broadcast_is_on_time_during_lookups(db_params: Dict[str, Any]) -> None:
+    # eventlet patches the whole process, so the benchmark runs in its own
+    result = subprocess.run(
+        [sys.executable, "-m", "aviatracker.scripts.benchmark", "broadcast-jitter"]
+        + ["--interval", "0.5", "--seconds", "5", "--clients", "10", "--query-seconds", "0.3", "--no-blocking"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert result.stdout.startswith("green:")
+
+
+def test_broadcast_is_on_time_while_flight_lookups_wait_for_the_db(scratch_db: DB) -> None:
+    with scratch_db:
+        with scratch_db.conn.cursor() as curs:
+            curs.execute("SHOW search_path")
+            (schema,) = curs.fetchone()
+    # the web app runs in a process of its own, its connections use the tables of the scratch schema
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))
+    env = dict(os.environ, PGOPTIONS=f"-c search_path={schema}", PYTHONPATH=path)
+    result = subprocess.run(
+        [sys.executable, __file__],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    measured = json.loads(result.stdout.splitlines()[-1])
+    assert measured["lateness"] and max(measured["lateness"]) < INTERVAL / 10
+    assert max(measured["lookups"]) > LOCK_SECONDS / 2, "no lookup has waited for the DB"
+
+
+def measure() -> None:
+    """Broadcasts every INTERVAL seconds while clients look up a flight through the pooled connections of the web
+    app and the table of the lookups is locked for LOCK_SECONDS at a time, so every lookup waits in Postgres"""
+    from aviatracker.config import common_conf
+    from aviatracker.database import PoolTimeout, patch_psycopg
+    from aviatracker.web import app
+
+    patch_psycopg()
+    params = common_conf.db_params
+    begin = time.monotonic()
+    end = begin + SECONDS
+    lateness: List[float] = []
+    lookups: List[float] = []
+
+    def broadcast() -> None:
+        due = begin
+        while due + INTERVAL < end:
+            due += INTERVAL
+            eventlet.sleep(max(due - time.monotonic(), 0))
+            lateness.append(time.monotonic() - due)
+
+    def lock() -> None:
+        db = DB(**params)
+        while time.monotonic() < end:
+            with db:
+                with db.conn.cursor() as curs:
+                    curs.execute("LOCK TABLE active_flights IN ACCESS EXCLUSIVE MODE")
+                    curs.execute("SELECT pg_sleep(%s)", (LOCK_SECONDS,))
+            eventlet.sleep(0.05)
+        db.close()
+
+    def lookup() -> None:
+        while time.monotonic() < end:
+            start = time.monotonic()
+            try:
+                app.fetch_current_flight("abc123", app.DEFAULT_PATH_ZOOM, params)
+            except PoolTimeout:
+                pass
+            lookups.append(time.monotonic() - start)
+
+    pool = eventlet.GreenPool()
+    pool.spawn(lock)
+    eventlet.sleep(0.1)
+    for _ in range(8):
+        pool.spawn(lookup)
+    pool.spawn(broadcast)
+    pool.waitall()
+    print(json.dumps({"lateness": lateness, "lookups": lookups}))
+
+
+if __name__ == "__main__":
+    measure()
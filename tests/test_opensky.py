@@ -0,0 +1,72 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, Iterator, List, Tuple
+
+from aviatracker.metrics import ThreadingHTTPServer
+from aviatracker.opensky import Opensky
+
+Reply = Tuple[int, Dict[str, str], bytes]
+
+
+@contextmanager
+def stub_server(replies: List[Reply], requests: List[float]) -> Iterator[str]:
+    """Serves the replies in their order, the time of every request is appended to requests"""
+    pending = list(replies)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            requests.append(time.monotonic())
+            status, headers, body = pending.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/api"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_rate_limited_request_is_retried_after_the_delay_of_opensky() -> None:
+    requests: List[float] = []
+    replies = [(429, {"X-Rate-Limit-Retry-After-Seconds": "1"}, b""), (200, {}, b'{"time": 1, "states": []}')]
+    with stub_server(replies, requests) as url:
+        api = Opensky("", "", url, retries=2, max_backoff=5)
+        assert api.get_from_opensky({"time": 0}, "/states/all", 5) == {"time": 1, "states": []}
+    assert len(requests) == 2
+    assert 1 <= requests[1] - requests[0] < 2
+
+
+def test_request_is_given_up_when_the_delay_of_opensky_exceeds_max_backoff() -> None:
+    requests: List[float] = []
+    start = time.monotonic()
+    with stub_server([(429, {"X-Rate-Limit-Retry-After-Seconds": "60"}, b"")], requests) as url:
+        api = Opensky("", "", url, retries=2, max_backoff=5)
+        assert api.get_from_opensky({"time": 0}, "/states/all", 5) is None
+    assert len(requests) == 1
+    assert time.monotonic() - start < 1
+
+
+def test_server_errors_are_retried_with_backoff() -> None:
+    requests: List[float] = []
+    with stub_server([(503, {}, b""), (502, {}, b""), (200, {}, b"[]")], requests) as url:
+        api = Opensky("", "", url, retries=2, backoff=0.01)
+        assert api.get_from_opensky({"begin": 0, "end": 3600}, "/flights/all", 5) == []
+    assert len(requests) == 3
+
+    requests.clear()
+    with stub_server([(500, {}, b"")] * 3, requests) as url:
+        api = Opensky("", "", url, retries=2, backoff=0.01)
+        assert api.get_from_opensky({"begin": 0, "end": 3600}, "/flights/all", 5) is None
+    assert len(requests) == 3
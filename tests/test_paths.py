@@ -0,0 +1,45 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from aviatracker.database import DB
+
+
+def test_legacy_points_are_returned_only_with_the_whole_path(scratch_db: DB) -> None:
+    db = scratch_db
+    now = int(time.time())
+    legacy = [{"longitude": 10.0, "latitude": 50.0}, {"longitude": 10.5, "latitude": 50.5}]
+    with db:
+        yesterday = datetime.utcnow().date() - timedelta(days=1)
+        db.create_day_partitions("flight_paths", yesterday, 3)
+        db.create_day_partitions("flight_path_points", yesterday, 3)
+        with db.conn.cursor() as curs:
+            curs.execute(
+                "INSERT INTO flight_paths (started_at, last_update, icao24, callsign, path, finished) "
+                "VALUES (%s, %s, 'abc123', 'TEST1', %s, False) RETURNING path_id",
+                (now - 600, now, json.dumps(legacy)),
+            )
+            (path_id,) = curs.fetchone()
+            curs.execute(
+                "INSERT INTO active_flights (icao24, path_id, started_at, last_update) VALUES ('abc123', %s, %s, %s)",
+                (path_id, now - 600, now),
+            )
+
+    with db:
+        found = db.get_unfinished_path_points("abc123")
+        assert found is not None
+        flight, points = found
+        assert flight["path_id"] == path_id
+        assert points == [(0, 10.0, 50.0), (0, 10.5, 50.5)]
+        assert db.get_unfinished_path_points("abc123", 0) == (flight, [])
+
+        with db.conn.cursor() as curs:
+            curs.execute(
+                "INSERT INTO flight_path_points (path_id, ts, longitude, latitude) "
+                "VALUES (%s, %s, 11.0, 51.0) RETURNING point_id",
+                (path_id, now),
+            )
+            (point_id,) = curs.fetchone()
+        assert db.get_unfinished_path_points("abc123", 0) == (flight, [(point_id, 11.0, 51.0)])
+        assert db.get_unfinished_path_points("abc123", point_id) == (flight, [])
+        assert db.get_unfinished_path_points("abc123") == (flight, points + [(point_id, 11.0, 51.0)])
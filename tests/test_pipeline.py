@@ -0,0 +1,51 @@
+import threading
+import time
+from typing import List
+
+from aviatracker.database import CALLSIGNS_CHANNEL, STATES_CHANNEL
+from aviatracker.pipeline import LocalSnapshotListener, PathsUpdater
+
+
+def test_update_runs_once_per_snapshot() -> None:
+    listener = LocalSnapshotListener()
+    updater = PathsUpdater(listener, min_interval=0, idle_interval=10)
+    updates: List[int] = []
+
+    listener.publish(STATES_CHANNEL, "100")
+    assert updater.step(lambda: updates.append(updater.applied_time))
+    listener.publish(STATES_CHANNEL, "100")
+    assert not updater.step(lambda: updates.append(updater.applied_time))
+    assert updates == [0]
+    assert updater.applied_time == 100
+
+
+def test_snapshots_within_min_interval_are_coalesced() -> None:
+    listener = LocalSnapshotListener()
+    updater = PathsUpdater(listener, min_interval=0.3, idle_interval=10)
+    runs: List[float] = []
+
+    listener.publish(STATES_CHANNEL, "100")
+    assert updater.step(lambda: runs.append(time.monotonic()))
+
+    listener.publish(STATES_CHANNEL, "105")
+    timer = threading.Timer(0.1, listener.publish, (STATES_CHANNEL, "110"))
+    timer.start()
+    assert updater.step(lambda: runs.append(time.monotonic()))
+    timer.join()
+
+    assert len(runs) == 2
+    assert runs[1] - runs[0] >= 0.3
+    assert updater.applied_time == 110
+
+
+def test_paths_are_updated_when_the_ingest_is_quiet() -> None:
+    listener = LocalSnapshotListener()
+    updater = PathsUpdater(listener, min_interval=0, idle_interval=0.1)
+    updates: List[int] = []
+
+    assert updater.step(lambda: updates.append(1))
+    # other notifications do not count as a snapshot, the idle interval has not passed yet
+    listener.publish(CALLSIGNS_CHANNEL)
+    assert not updater.step(lambda: updates.append(1))
+    assert updates == [1]
+    assert updater.applied_time == 0
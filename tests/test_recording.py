@@ -0,0 +1,35 @@
+import multiprocessing
+import os
+from typing import Any
+
+from aviatracker.recording import ResponseLog, ResponseRecorder
+
+WORKERS = 4
+RECORDS = 3000
+
+
+def record(recorder: ResponseRecorder, worker: int, start: Any) -> None:
+    start.wait()
+    for i in range(RECORDS):
+        body = b'"' + os.urandom(200 * (1 + i % 4)).hex().encode() + b'"'
+        recorder.record(f"states:{worker}", worker * RECORDS + i, body)
+
+
+def test_processes_forked_after_the_recorder_do_not_interleave_records(tmp_path: Any) -> None:
+    path = str(tmp_path / "responses.log")
+    # Celery forks its workers after the tasks module has created the recorder
+    recorder = ResponseRecorder(path, level=0)
+    context = multiprocessing.get_context("fork")
+    start = context.Barrier(WORKERS)
+    workers = [context.Process(target=record, args=(recorder, worker, start)) for worker in range(WORKERS)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+
+    log = ResponseLog(path)
+    assert log.times == list(range(WORKERS * RECORDS))
+    for request_time, offset in zip(log.times, log.offsets):
+        recorded_time, operation, _ = log.read(offset)
+        assert (recorded_time, operation) == (request_time, f"states:{request_time // RECORDS}")
@@ -0,0 +1,67 @@
+import calendar
+import os
+from datetime import datetime, timedelta
+
+import yaml
+
+from aviatracker.database import DB
+
+
+def test_stats_of_days_without_partitions_are_added(scratch_db: DB) -> None:
+    db = scratch_db
+    today = datetime.utcnow().date()
+    now = calendar.timegm(today.timetuple()) + 43200
+    missed = now - 3 * 86400
+    outdated = now - 40 * 86400
+    with db:
+        db.create_day_partitions("flight_paths", today - timedelta(days=41), 42)
+        with db.conn.cursor() as curs:
+            for icao24, last_update in (("a", missed), ("b", missed), ("c", outdated)):
+                curs.execute(
+                    "INSERT INTO flight_paths (started_at, last_update, icao24, departure_airport_icao, "
+                    "arrival_airport_icao, finished, finished_at) VALUES (%s, %s, %s, 'EDDF', 'LFPG', True, %s)",
+                    (last_update - 3600, last_update, icao24, now),
+                )
+
+    # airport_stats has no partitions at all, as if the maintenance had not run for a while
+    with db:
+        assert db.add_finished_paths_to_stats(0, today - timedelta(days=31)) == now
+        with db.conn.cursor() as curs:
+            curs.execute(
+                "SELECT airport_icao, the_date, airplane_quantity_arrivals, airplane_quantity_departures "
+                "FROM airport_stats ORDER BY airport_icao"
+            )
+            rows = curs.fetchall()
+    missed_day = today - timedelta(days=3)
+    assert rows == [("EDDF", missed_day, 0, 2), ("LFPG", missed_day, 2, 0)]
+
+
+def test_watermark_of_last_update_is_migrated_to_finished_at(scratch_db: DB) -> None:
+    db = scratch_db
+    path = os.path.join(os.path.dirname(__file__), "..", "aviatracker", "scripts", "make_tables.yaml")
+    with open(path, "r") as f:
+        migration = yaml.load(f, Loader=yaml.FullLoader)["migrate_airport_stats_last_update"]
+    today = datetime.utcnow().date()
+    now = calendar.timegm(today.timetuple()) + 43200
+    with db:
+        db.create_day_partitions("flight_paths", today - timedelta(days=1), 2)
+        with db.conn.cursor() as curs:
+            # the table as it was when the watermark was the last_update of the latest counted path
+            curs.execute(
+                "DROP TABLE airport_stats_last_update; CREATE TABLE airport_stats_last_update ("
+                "update_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, last_stats_update_time INTEGER)"
+            )
+            curs.execute("INSERT INTO airport_stats_last_update (last_stats_update_time) VALUES (%s)", (now - 1000,))
+            curs.execute(
+                "INSERT INTO flight_paths (started_at, last_update, icao24, arrival_airport_icao, finished, "
+                "finished_at) VALUES (%s, %s, 'a', 'EDDF', True, %s)",
+                (now - 7200, now - 3600, now - 100),
+            )
+
+    db.execute_script(migration)
+    db.execute_script(migration)
+    with db:
+        assert db.get_stats_last_update() == now - 100
+        assert db.add_finished_paths_to_stats(now - 100) == now - 100
+        db.update_airport_stats_last_update(now)
+        assert db.get_stats_last_update() == now
@@ -0,0 +1,24 @@
+import pytest
+
+from aviatracker.web.trajectory import tolerance_for_zoom
+from aviatracker.web.viewport import MAX_ZOOM, Viewport, parse_viewport, parse_zoom
+
+
+def test_viewport_is_clamped() -> None:
+    assert parse_viewport(["-200", -100, 1000, 95.5, 40]) == Viewport(-200.0, -90.0, 360.0, 90.0, MAX_ZOOM)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [[1, 2, 3, 4], [1, 2, 3, 4, 5, 6], ["nan", 2, 3, 4, 5], [1, "inf", 3, 4, 5], [1, 2, 3, 4, None], [1, 2, "x", 4, 5]],
+)
+def test_invalid_viewports_are_rejected(values: list) -> None:
+    assert parse_viewport(values) is None
+
+
+def test_zoom_is_clamped_before_the_tolerance_is_computed() -> None:
+    assert parse_zoom("-3") == 0.0
+    assert parse_zoom(1e6) == MAX_ZOOM
+    assert tolerance_for_zoom(MAX_ZOOM) > 0
+    assert parse_zoom("inf") is None
+    assert parse_zoom([6]) is None